@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import log
+
+# Parsed annotations are cached next to the csv and rebuilt when the csv size or mtime changes
+ANNOTATION_CACHE_SUFFIX = '.annotations.npz'
+
+
+class AnnotationStore:
+    # Annotation rows grouped by patient ID: rows of one patient are contiguous in `values`
+    # (one float64 column per numeric csv column) between offsets[i] and offsets[i + 1].
+
+    def __init__(self, ids, offsets, columns, values):
+        self.ids = ids
+        self.offsets = offsets
+        self.columns = list(columns)
+        self.values = values
+        self._column_index = {column: i for i, column in enumerate(self.columns)}
+        self._patient_index = {patient_id: i for i, patient_id in enumerate(ids.tolist())}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, patient_id):
+        return str(patient_id) in self._patient_index
+
+    def patients(self):
+        return self.ids.tolist()
+
+    def count(self, patient_id):
+        i = self._patient_index.get(str(patient_id))
+        return 0 if i is None else int(self.offsets[i + 1] - self.offsets[i])
+
+    def rows(self, patient_id):
+        # (n, num_columns) view of the annotations of one patient, empty if the patient has none
+        i = self._patient_index.get(str(patient_id))
+        if i is None:
+            return self.values[:0]
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def patient(self, patient_id):
+        # {column: array} for one patient; accepted by export_centered_patches in place of a DataFrame
+        rows = self.rows(patient_id)
+        return {column: rows[:, i] for column, i in self._column_index.items()}
+
+    def coordinates(self, patient_id, columns):
+        return self.rows(patient_id)[:, [self._column_index[column] for column in columns]]
+
+    def frame(self, patient_id):
+        frame = pd.DataFrame(self.rows(patient_id), columns=self.columns)
+        frame.insert(0, 'ID', str(patient_id))
+        return frame
+
+    @classmethod
+    def from_csv(cls, annotation_csv):
+        # Same rows as read_annotation_data: rows with missing values are dropped
+        df_annotation = pd.read_csv(annotation_csv).dropna()
+        patient_ids = df_annotation['ID'].astype(str).to_numpy(dtype=str)
+        numeric = df_annotation.drop(columns=['ID']).select_dtypes(include='number')
+        order = np.argsort(patient_ids, kind='stable')
+        ids, starts = np.unique(patient_ids[order], return_index=True)
+        offsets = np.append(starts, len(order)).astype(np.int64)
+        values = np.ascontiguousarray(numeric.to_numpy(dtype=np.float64)[order])
+        return cls(ids, offsets, numeric.columns, values)
+
+    def save(self, path, source_stat=None):
+        size, mtime_ns = source_stat if source_stat is not None else (-1, -1)
+        with open(path + '.tmp', 'wb') as fh:
+            np.savez(fh, ids=self.ids, offsets=self.offsets, columns=np.array(self.columns, dtype=str),
+                     values=self.values, source=np.array([size, mtime_ns], dtype=np.int64))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['ids'], data['offsets'], data['columns'].tolist(), data['values'])
+
+    @classmethod
+    def open(cls, annotation_csv, cache_path=None):
+        # Loads the cached binary form if it is up to date with the csv, otherwise parses the csv and caches it
+        cache_path = cache_path or annotation_csv + ANNOTATION_CACHE_SUFFIX
+        stat = os.stat(annotation_csv)
+        source = [stat.st_size, stat.st_mtime_ns]
+        if os.path.isfile(cache_path):
+            with np.load(cache_path) as data:
+                fresh = data['source'].tolist() == source
+            if fresh:
+                store = cls.load(cache_path)
+                log("AnnotationStore.open|Info: {} annotations for {} patients {} (cached)".format(
+                    len(store), len(store.ids), annotation_csv))
+                return store
+        store = cls.from_csv(annotation_csv)
+        try:
+            store.save(cache_path, source)
+        except OSError as e:
+            log("AnnotationStore.open|Error: could not write cache", cache_path, str(e))
+        log("AnnotationStore.open|Info: {} annotations for {} patients {}".format(
+            len(store), len(store.ids), annotation_csv))
+        return store
@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+from skimage.transform import resize
+
+from benchmarks import make_thorax_phantom, _traced_peak
+from dcm_utilities import load_ct_scan, get_pixels_hu, load_ct_volume
+from utilities import resample_ct_pixels, truncate_hu, normalize, normalize_hu, compute_lung_mask, crop_ct_lungs
+from utilities import resample_to_model_grid
+from utilities import export_normal_patches, export_normal_slices, export_centered_patches
+
+# Relative slowdown (or peak memory growth) over the baseline that counts as a regression;
+# timings below BENCHMARK_MIN_SECONDS are too noisy to compare
+BENCHMARK_TOLERANCE = 0.25
+BENCHMARK_MIN_SECONDS = 0.005
+BENCHMARK_DEFAULTS = {'num_slices': 64, 'size': 256, 'spacing': [2.5, 0.7, 0.7], 'slope': 1.0, 'intercept': -1024.0,
+                      'seed': 0}
+
+
+def write_dicom_phantom(out_dir, num_slices=64, size=256, spacing=(2.5, 0.7, 0.7), slope=1.0, intercept=-1024.0,
+                        seed=0):
+    # One CT series of make_thorax_phantom slices as .dcm files, stored as rint((HU - intercept) / slope)
+    # in signed 16 bit. Files are named in shuffled order so loaders have to sort by ImagePositionPatient.
+    os.makedirs(out_dir, exist_ok=True)
+    hu = make_thorax_phantom(num_slices, size, seed)
+    stored = np.clip(np.rint((hu - intercept) / slope), -32768, 32767).astype(np.int16)
+    study_uid, series_uid = generate_uid(), generate_uid()
+    order = np.random.default_rng(seed).permutation(num_slices)
+    dcm_files = []
+    for file_number, i in enumerate(order):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = FileDataset(None, {}, file_meta=meta, preamble=b'\0' * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.Modality = 'CT'
+        ds.Manufacturer = 'SYNTHETIC'
+        ds.ManufacturerModelName = 'Thorax phantom'
+        ds.PatientID = 'PHANTOM'
+        ds.ImageType = ['ORIGINAL', 'PRIMARY', 'AXIAL']
+        ds.InstanceNumber = int(i) + 1
+        ds.ImagePositionPatient = [0.0, 0.0, float(i) * spacing[0]]
+        ds.SliceLocation = float(i) * spacing[0]
+        ds.SliceThickness = spacing[0]
+        ds.PixelSpacing = [spacing[1], spacing[2]]
+        ds.Rows = ds.Columns = size
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.RescaleSlope = slope
+        ds.RescaleIntercept = intercept
+        ds.PixelData = stored[i].tobytes()
+        dcm_file = os.path.join(out_dir, 'IM{:04d}.dcm'.format(file_number))
+        ds.save_as(dcm_file, write_like_original=False)
+        dcm_files.append(dcm_file)
+    print("write_dicom_phantom|Info ==> {} slices of {}x{} to: {}".format(num_slices, size, size, out_dir))
+    return dcm_files
+
+
+def measure(fn, make_args=None, repeats=3, voxels=0):
+    # Best/mean wall time over repeats (make_args builds fresh (args, kwargs) outside the timed region,
+    # for functions that modify their input), then one traced run for the peak of numpy/Python allocations
+    make_args = make_args or (lambda: ((), {}))
+    timings = []
+    for _ in range(repeats):
+        args, kwargs = make_args()
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    args, kwargs = make_args()
+    _, peak = _traced_peak(fn, *args, **kwargs)
+    best = min(timings)
+    return {'seconds': best, 'mean_seconds': float(np.mean(timings)), 'repeats': repeats,
+            'mvoxels_per_second': voxels / best / 1e6 if voxels and best > 0 else None, 'peak_mb': peak / 2 ** 20}
+
+
+def _truncate_normalize(ct_pixels_hu):
+    return normalize(truncate_hu(ct_pixels_hu))
+
+
+def _model_grid_chain(ct_pixels_hu, spacing, out_size=128):
+    # The inference geometry as three resamplings, as before resample_to_model_grid
+    ct_norm = normalize_hu(resample_ct_pixels(ct_pixels_hu, spacing), np.float32)
+    return resize(ct_norm, (ct_norm.shape[0], out_size, out_size), anti_aliasing=True)
+
+
+def _end_to_end(dcm_dir, out_path):
+    ct_pixels_hu, spacing = load_ct_volume(dcm_dir)
+    ct_resampled_hu = resample_ct_pixels(ct_pixels_hu, spacing)
+    lung_mask = compute_lung_mask(ct_resampled_hu)
+    ct_norm = crop_ct_lungs(normalize_hu(ct_resampled_hu, np.float64), lung_mask)
+    export_normal_slices(ct_norm, None, None, out_path, 'H_0001', 'bench')
+
+
+def run_benchmark_suite(work_dir=None, num_slices=64, size=256, spacing=(2.5, 0.7, 0.7), slope=1.0,
+                        intercept=-1024.0, seed=0, repeats=3, only=None):
+    # Per-function and end-to-end benchmarks of the preprocessing steps on a synthetic series.
+    # Returns {'meta': ..., 'benchmarks': {name: measure() result}}, see save_results/compare_results.
+    cleanup = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp()
+    dcm_dir = os.path.join(work_dir, 'dcm')
+    out_path = os.path.join(work_dir, 'out', '')
+    os.makedirs(out_path, exist_ok=True)
+    write_dicom_phantom(dcm_dir, num_slices, size, spacing, slope, intercept, seed)
+
+    slices, ct_spacing = load_ct_scan(dcm_dir)
+    ct_pixels_hu = get_pixels_hu(slices)
+    ct_resampled_hu = resample_ct_pixels(ct_pixels_hu, ct_spacing)
+    lung_mask = compute_lung_mask(ct_resampled_hu)
+    ct_norm = normalize(truncate_hu(ct_resampled_hu.astype(np.float64)))
+    ct_cropped = crop_ct_lungs(ct_norm, lung_mask)
+    centers = {'Center_z (px)': np.linspace(1, num_slices - 2, 32),
+               'Center_y (px)': np.full(32, size * 0.5), 'Center_x (px)': np.linspace(size * 0.2, size * 0.8, 32)}
+    raw, resampled, cropped = ct_pixels_hu.size, ct_resampled_hu.size, ct_cropped.size
+
+    cases = [
+        ('load_ct_scan', lambda: load_ct_scan(dcm_dir), None, raw),
+        ('get_pixels_hu', get_pixels_hu, lambda: ((slices,), {}), raw),
+        ('load_ct_volume', lambda: load_ct_volume(dcm_dir), None, raw),
+        ('resample_ct_pixels', resample_ct_pixels, lambda: ((ct_pixels_hu, ct_spacing), {}), raw),
+        ('model_grid[chain]', _model_grid_chain, lambda: ((ct_pixels_hu, ct_spacing), {}), raw),
+        ('resample_to_model_grid', resample_to_model_grid, lambda: ((ct_pixels_hu, ct_spacing), {}), raw),
+        ('truncate_normalize', _truncate_normalize, lambda: ((ct_resampled_hu.astype(np.float64),), {}), resampled),
+        ('normalize_hu', normalize_hu, lambda: ((ct_resampled_hu, np.float64), {}), resampled),
+        ('compute_lung_mask', compute_lung_mask, lambda: ((ct_resampled_hu,), {}), resampled),
+        ('compute_lung_mask[coarse]', compute_lung_mask, lambda: ((ct_resampled_hu,), {'mode': 'coarse'}), resampled),
+        ('crop_ct_lungs', crop_ct_lungs, lambda: ((ct_norm, lung_mask), {'copy': True}), resampled),
+        ('export_normal_patches', export_normal_patches,
+         lambda: ((ct_cropped, (3, 64, 64), (5, 19, 21), out_path, 'H_0001', 'bench'), {}), cropped),
+        ('export_normal_slices', export_normal_slices,
+         lambda: ((ct_cropped, None, None, out_path, 'H_0001', 'bench'), {}), cropped),
+        ('export_centered_patches', export_centered_patches,
+         lambda: ((ct_norm, ct_spacing, ct_pixels_hu.shape, centers, (3, 128, 128), out_path, 'C_0001', 'bench'),
+                  {}), resampled),
+        ('end_to_end', _end_to_end, lambda: ((dcm_dir, out_path), {}), raw),
+    ]
+    benchmarks = {}
+    try:
+        for name, fn, make_args, voxels in cases:
+            if only and name not in only:
+                continue
+            print("run_benchmark_suite|Info ==> running", name)
+            benchmarks[name] = measure(fn, make_args, repeats, voxels)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    meta = {'num_slices': num_slices, 'size': size, 'spacing': [float(s) for s in spacing], 'slope': slope,
+            'intercept': intercept, 'seed': seed, 'repeats': repeats,
+            'resampled_shape': list(ct_resampled_hu.shape), 'cropped_shape': list(ct_cropped.shape),
+            'python': platform.python_version(), 'numpy': np.__version__, 'pydicom': pydicom.__version__,
+            'machine': platform.machine(), 'cpu_count': os.cpu_count(), 'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    return {'meta': meta, 'benchmarks': benchmarks}
+
+
+def save_results(results, path):
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    print("save_results|Info ==> benchmark results saved to:", path)
+
+
+def load_results(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def compare_results(results, baseline, tolerance=BENCHMARK_TOLERANCE, min_seconds=BENCHMARK_MIN_SECONDS):
+    # Prints each benchmark against the baseline and returns the names that regressed in time or peak memory
+    regressions = []
+    for key in ('num_slices', 'size', 'spacing', 'slope', 'intercept'):
+        if results['meta'].get(key) != baseline['meta'].get(key):
+            print("compare_results|Warn: {} differs from the baseline: {} vs {}".format(
+                key, results['meta'].get(key), baseline['meta'].get(key)))
+    print("{:<28} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+        'benchmark', 'seconds', 'baseline', 'ratio', 'peak MB', 'baseline', 'ratio'))
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            print("{:<28} {:10.3f} {:>10}".format(name, result['seconds'], 'new'))
+            continue
+        time_ratio = result['seconds'] / max(base['seconds'], 1e-9)
+        peak_ratio = result['peak_mb'] / max(base['peak_mb'], 1e-3)
+        slower = time_ratio > 1 + tolerance and result['seconds'] - base['seconds'] > min_seconds
+        larger = peak_ratio > 1 + tolerance and result['peak_mb'] - base['peak_mb'] > 1.
+        print("{:<28} {:10.3f} {:10.3f} {:8.2f} {:10.1f} {:10.1f} {:8.2f}{}".format(
+            name, result['seconds'], base['seconds'], time_ratio, result['peak_mb'], base['peak_mb'], peak_ratio,
+            '  REGRESSION' if slower or larger else ''))
+        if slower or larger:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing steps on a synthetic DICOM series")
+    parser.add_argument('--out', default='benchmark-results.json', help="JSON file for the results")
+    parser.add_argument('--baseline', help="JSON results to compare against; exit code 1 on a regression")
+    parser.add_argument('--save-baseline', action='store_true', help="also write the results to --baseline")
+    parser.add_argument('--tolerance', type=float, default=BENCHMARK_TOLERANCE)
+    parser.add_argument('--slices', type=int, default=BENCHMARK_DEFAULTS['num_slices'])
+    parser.add_argument('--size', type=int, default=BENCHMARK_DEFAULTS['size'], help="rows and columns per slice")
+    parser.add_argument('--spacing', type=float, nargs=3, default=BENCHMARK_DEFAULTS['spacing'],
+                        help="slice spacing and pixel spacing in mm (z, y, x)")
+    parser.add_argument('--slope', type=float, default=BENCHMARK_DEFAULTS['slope'])
+    parser.add_argument('--intercept', type=float, default=BENCHMARK_DEFAULTS['intercept'])
+    parser.add_argument('--seed', type=int, default=BENCHMARK_DEFAULTS['seed'])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--only', nargs='+', help="run only these benchmarks")
+    parser.add_argument('--work-dir', help="keep the synthetic series and outputs in this folder")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark_suite(args.work_dir, args.slices, args.size, args.spacing, args.slope, args.intercept,
+                                  args.seed, args.repeats, args.only)
+    save_results(results, args.out)
+    if args.baseline and args.save_baseline:
+        save_results(results, args.baseline)
+    elif args.baseline:
+        regressions = compare_results(results, load_results(args.baseline), args.tolerance)
+        if regressions:
+            print("main|Error: regressions in", ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
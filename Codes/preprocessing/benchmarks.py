@@ -0,0 +1,194 @@
+import glob
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.ndimage
+
+from dcm_utilities import load_ct_scan, get_pixels_hu, load_ct_volume
+from utilities import truncate_hu, normalize, normalize_hu, resample_ct_pixels, resample_ct_pixels_parallel
+from utilities import compute_lung_mask, export_normal_patches, export_normal_slices
+from volume_store import STORAGE_POLICIES, load_slices
+
+
+def make_thorax_phantom(num_slices=64, size=256, seed=0):
+    # HU volume with air around an elliptic body (soft tissue), two lungs whose cross-section varies
+    # along z, vessels inside the lungs, a spine and a few small air pockets (trachea, bowel gas)
+    rng = np.random.default_rng(seed)
+    y, x = np.meshgrid(np.linspace(-1, 1, size), np.linspace(-1, 1, size), indexing='ij')
+    phantom = np.full((num_slices, size, size), -1000.0)
+    for i, z in enumerate(np.linspace(-1, 1, num_slices)):
+        ct_slice = phantom[i]
+        ct_slice[(x / 0.85) ** 2 + (y / 0.7) ** 2 < 1] = 40
+        lung_radius = 0.3 * np.sqrt(max(0., 1 - (z / 1.05) ** 2))
+        for side in (-1, 1):
+            ct_slice[((x - side * 0.38) / 1.1) ** 2 + (y / 1.3) ** 2 < lung_radius ** 2] = -850
+        ct_slice[(x / 0.08) ** 2 + ((y - 0.5) / 0.08) ** 2 < 1] = 700
+        ct_slice[x ** 2 + (y + 0.35) ** 2 < 0.03 ** 2] = -1000
+        ct_slice[(x - 0.1) ** 2 + (y - 0.3) ** 2 < 0.02 ** 2] = -950
+    vessels = scipy.ndimage.binary_dilation(rng.random(phantom.shape) < 0.002)
+    phantom[vessels & (phantom == -850)] = 50
+    phantom += rng.normal(0, 20, phantom.shape)
+    return phantom.astype(np.int16)
+
+
+def time_function(fn, *args, repeats=3, **kwargs):
+    timings = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return result, {'best': min(timings), 'mean': float(np.mean(timings))}
+
+
+def _load_ct_scan_hu(path):
+    slices, spacing = load_ct_scan(path)
+    return get_pixels_hu(slices), spacing
+
+
+def benchmark_load_ct_scan(path, workers=(1, 2, 4, 8), use_processes=False, repeats=3):
+    (reference, reference_spacing), timing = time_function(_load_ct_scan_hu, path, repeats=repeats)
+    results = {'load_ct_scan': timing}
+    for num_workers in workers:
+        (volume, spacing), timing = time_function(load_ct_volume, path, repeats=repeats,
+                                                  workers=num_workers, use_processes=use_processes)
+        assert np.array_equal(volume, reference), "load_ct_volume output differs from load_ct_scan"
+        assert np.allclose(spacing, reference_spacing)
+        results['load_ct_volume[{}]'.format(num_workers)] = timing
+
+    baseline = results['load_ct_scan']['best']
+    print("benchmark_load_ct_scan|Info ==> {} slices from: {}".format(reference.shape[0], path))
+    for name, timing in results.items():
+        print("{:<24} best {:8.3f}s  mean {:8.3f}s  speedup x{:.2f}".format(
+            name, timing['best'], timing['mean'], baseline / timing['best']))
+    return results
+
+
+def benchmark_normalize(ct_pixels_hu, dtypes=(np.float64, np.float32, np.float16, np.uint8), repeats=3):
+    # truncate_hu modifies its input, so the reference path gets a fresh copy on every run
+    reference, timing = time_function(lambda: normalize(truncate_hu(ct_pixels_hu.copy())), repeats=repeats)
+    results = {'truncate_hu+normalize': dict(timing, max_abs_error=0.0)}
+    for dtype in dtypes:
+        out = np.empty(ct_pixels_hu.shape, dtype=dtype)
+        normalized, timing = time_function(normalize_hu, ct_pixels_hu, repeats=repeats, out=out)
+        scale = 255. if np.dtype(dtype) == np.uint8 else 1.
+        error = float(np.max(np.abs(normalized / scale - reference)))
+        results['normalize_hu[{}]'.format(np.dtype(dtype).name)] = dict(timing, max_abs_error=error)
+
+    baseline = results['truncate_hu+normalize']['best']
+    print("benchmark_normalize|Info ==> volume", str(ct_pixels_hu.shape), ct_pixels_hu.dtype)
+    for name, timing in results.items():
+        print("{:<24} best {:8.3f}s  mean {:8.3f}s  speedup x{:.2f}  max error {:.2e}".format(
+            name, timing['best'], timing['mean'], baseline / timing['best'], timing['max_abs_error']))
+    return results
+
+
+def benchmark_resample(ct_pixels, ct_pixel_spacing, workers=(1, 2, 4, 8), order=3, repeats=1):
+    reference, timing = time_function(resample_ct_pixels, ct_pixels, ct_pixel_spacing, repeats=repeats)
+    results = {'resample_ct_pixels': dict(timing, max_abs_error=0.0)}
+    for num_workers in workers:
+        resampled, timing = time_function(resample_ct_pixels_parallel, ct_pixels, ct_pixel_spacing, repeats=repeats,
+                                          order=order, workers=num_workers)
+        error = float(np.max(np.abs(resampled.astype(np.float64) - reference)))
+        results['resample_ct_pixels_parallel[{}]'.format(num_workers)] = dict(timing, max_abs_error=error)
+
+    baseline = results['resample_ct_pixels']['best']
+    print("benchmark_resample|Info ==> volume", str(ct_pixels.shape), "spacing", ct_pixel_spacing, "order", order)
+    for name, timing in results.items():
+        print("{:<32} best {:8.3f}s  mean {:8.3f}s  speedup x{:.2f}  max error {:.2e}".format(
+            name, timing['best'], timing['mean'], baseline / timing['best'], timing['max_abs_error']))
+    return results
+
+
+def benchmark_lung_mask(ct_pixels_hu, workers=(1, 2, 4, 8), repeats=1):
+    reference, timing = time_function(compute_lung_mask, ct_pixels_hu, repeats=repeats)
+    results = {'compute_lung_mask': dict(timing, mismatched_voxels=0)}
+    for num_workers in workers:
+        mask, timing = time_function(compute_lung_mask, ct_pixels_hu, repeats=repeats, workers=num_workers)
+        results['compute_lung_mask[{}]'.format(num_workers)] = dict(
+            timing, mismatched_voxels=int(np.count_nonzero(mask != reference)))
+    for mode in ('3d', 'coarse'):
+        mask, timing = time_function(compute_lung_mask, ct_pixels_hu, repeats=repeats, workers=max(workers), mode=mode)
+        results['compute_lung_mask[{}]'.format(mode)] = dict(
+            timing, mismatched_voxels=int(np.count_nonzero(mask != reference)))
+
+    baseline = results['compute_lung_mask']['best']
+    print("benchmark_lung_mask|Info ==> volume", str(ct_pixels_hu.shape))
+    for name, timing in results.items():
+        print("{:<26} best {:8.3f}s  mean {:8.3f}s  speedup x{:.2f}  mismatched voxels {}".format(
+            name, timing['best'], timing['mean'], baseline / timing['best'], timing['mismatched_voxels']))
+    return results
+
+
+def _traced_peak(fn, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        fn(*args, **kwargs)
+        return time.perf_counter() - start, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_export_normal_patches(lung_seg_cropped, patch_shape=(3, 128, 128), stride=(17, 19, 21),
+                                    dtypes=(np.float64, np.float32, np.float16)):
+    # Wall time and peak traced numpy/Python allocations (memmap pages are not counted)
+    out_path = tempfile.mkdtemp() + os.sep
+    results = {}
+    runs = [('list', {'mode': 'list'})] + [('strided[{}]'.format(np.dtype(dtype).name), {'dtype': dtype})
+                                          for dtype in dtypes]
+    for name, kwargs in runs:
+        elapsed, peak = _traced_peak(export_normal_patches, lung_seg_cropped, patch_shape, stride, out_path,
+                                     name.split('[')[0] + '_', 'bench', **kwargs)
+        out_files = glob.glob(out_path + name.split('[')[0] + '_*')
+        results[name] = {'seconds': elapsed, 'peak_mb': peak / 2 ** 20,
+                         'file_mb': sum(os.path.getsize(f) for f in out_files) / 2 ** 20}
+        for out_file in out_files:
+            os.remove(out_file)
+    os.rmdir(out_path)
+
+    baseline = results['list']['seconds']
+    print("benchmark_export_normal_patches|Info ==> volume", str(lung_seg_cropped.shape),
+          "patch", patch_shape, "stride", stride)
+    for name, result in results.items():
+        print("{:<20} {:8.3f}s  speedup x{:.2f}  peak {:9.1f} MB  file {:9.1f} MB".format(
+            name, result['seconds'], baseline / result['seconds'], result['peak_mb'], result['file_mb']))
+    return results
+
+
+def verify_storage_policies(ct_pixels_hu, policies=tuple(STORAGE_POLICIES), store_formats=('npy', 'ctv')):
+    # Round trip normalize -> export_normal_slices -> load_slices for every policy, against float64.
+    # Worst case errors: half a quantization step for uint8, half an ulp at 1.0 for the float policies.
+    reference = normalize(truncate_hu(ct_pixels_hu.astype(np.float64)), 'float64')
+    bounds = {name: (0.5 / scale if scale else 0.5 * float(np.finfo(dtype).eps))
+              for name, (dtype, scale) in STORAGE_POLICIES.items()}
+    out_path = tempfile.mkdtemp() + os.sep
+    results = {}
+    for policy in policies:
+        stored = normalize(truncate_hu(ct_pixels_hu.astype(np.float64)), policy)
+        for store_format in store_formats:
+            prefix = '{}-{}_'.format(policy, store_format)
+            export_normal_slices(stored, None, None, out_path, prefix, 'verify', store_format=store_format,
+                                 policy=policy)
+            out_file, = glob.glob(out_path + prefix + '*')
+            error = float(np.max(np.abs(load_slices(out_file, dtype=np.float64) - reference)))
+            results[policy, store_format] = {'max_error': error, 'bound': bounds[policy], 'ok': error <= bounds[policy],
+                                             'ram_mb': stored.nbytes / 2 ** 20,
+                                             'file_mb': os.path.getsize(out_file) / 2 ** 20}
+            os.remove(out_file)
+    os.rmdir(out_path)
+
+    print("verify_storage_policies|Info ==> volume", str(ct_pixels_hu.shape))
+    for (policy, store_format), result in results.items():
+        print("{:<8} {:<4} max error {:.2e} (bound {:.2e}) {}  ram {:8.1f} MB  file {:8.1f} MB".format(
+            policy, store_format, result['max_error'], result['bound'], 'ok  ' if result['ok'] else 'FAIL',
+            result['ram_mb'], result['file_mb']))
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_load_ct_scan(sys.argv[1])
@@ -0,0 +1,187 @@
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+
+from dcm_utilities import metadata_value
+from instrumentation import log
+
+CATALOG_TAGS = ['SeriesInstanceUID',
+                'ImagePositionPatient',
+                'SliceLocation',
+                'SliceThickness',
+                'PixelSpacing',
+                'RescaleSlope',
+                'RescaleIntercept',
+                'ImageType',
+                'Rows',
+                'Columns']
+
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dcm_files (
+    path              TEXT PRIMARY KEY,
+    root              TEXT NOT NULL,
+    patient           TEXT NOT NULL,
+    subfolder         TEXT NOT NULL,
+    size              INTEGER NOT NULL,
+    mtime_ns          INTEGER NOT NULL,
+    series_uid        TEXT,
+    position_z        REAL,
+    image_position    TEXT,
+    slice_location    REAL,
+    slice_thickness   REAL,
+    pixel_spacing     TEXT,
+    rescale_slope     REAL,
+    rescale_intercept REAL,
+    image_type        TEXT,
+    rows              INTEGER,
+    columns           INTEGER
+);
+CREATE INDEX IF NOT EXISTS dcm_files_patient ON dcm_files (root, patient);
+CREATE INDEX IF NOT EXISTS dcm_files_series ON dcm_files (series_uid, position_z);
+'''
+
+_CATALOG_HEADER_COLUMNS = ['series_uid', 'position_z', 'image_position', 'slice_location', 'slice_thickness',
+                           'pixel_spacing', 'rescale_slope', 'rescale_intercept', 'image_type', 'rows', 'columns']
+
+_CATALOG_COLUMNS = ['path', 'root', 'patient', 'subfolder', 'size', 'mtime_ns'] + _CATALOG_HEADER_COLUMNS
+
+
+def _walk_dcm_files(root):
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".dcm"):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime_ns
+
+
+def _read_catalog_header(path):
+    header = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=CATALOG_TAGS)
+    values = {tag: metadata_value(header[tag]) if tag in header else None for tag in CATALOG_TAGS}
+    position = header.ImagePositionPatient if 'ImagePositionPatient' in header else None
+    return {'series_uid': values['SeriesInstanceUID'],
+            'position_z': float(position[2]) if position is not None else None,
+            'image_position': values['ImagePositionPatient'],
+            'slice_location': values['SliceLocation'],
+            'slice_thickness': values['SliceThickness'],
+            'pixel_spacing': values['PixelSpacing'],
+            'rescale_slope': values['RescaleSlope'],
+            'rescale_intercept': values['RescaleIntercept'],
+            'image_type': values['ImageType'],
+            'rows': values['Rows'],
+            'columns': values['Columns']}
+
+
+def _read_catalog_header_safe(path):
+    try:
+        return _read_catalog_header(path)
+    except Exception as e:
+        log("DicomCatalog.scan|Error:", path, str(e))
+        return None
+
+
+class DicomCatalog:
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(CATALOG_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def scan(self, root, workers=8):
+        # Only files that are new or whose size/mtime changed since the last scan are parsed
+        root = os.path.abspath(root)
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute(
+            'SELECT path, size, mtime_ns FROM dcm_files WHERE root = ?', (root,))}
+
+        changed = []
+        unchanged = 0
+        seen = set()
+        for path, size, mtime_ns in _walk_dcm_files(root):
+            if os.path.dirname(path) == root:  # process only files inside patient folders
+                continue
+            seen.add(path)
+            if known.get(path) == (size, mtime_ns):
+                unchanged += 1
+            else:
+                changed.append((path, size, mtime_ns))
+
+        records = []
+        failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            headers = executor.map(_read_catalog_header_safe, [path for path, _, _ in changed])
+            for (path, size, mtime_ns), header in zip(changed, headers):
+                if header is None:
+                    # Unreadable files are kept without header fields so they are not re-parsed on every scan
+                    failed += 1
+                    header = dict.fromkeys(_CATALOG_HEADER_COLUMNS)
+                patient, _, patient_path = os.path.relpath(path, root).partition(os.sep)
+                record = dict(header, path=path, root=root, patient=patient,
+                              subfolder=os.path.dirname(patient_path), size=size, mtime_ns=mtime_ns)
+                records.append([record[column] for column in _CATALOG_COLUMNS])
+
+        removed = [(path,) for path in known if path not in seen]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO dcm_files ({}) VALUES ({})'.format(
+                ', '.join(_CATALOG_COLUMNS), ', '.join('?' * len(_CATALOG_COLUMNS))), records)
+            self.connection.executemany('DELETE FROM dcm_files WHERE path = ?', removed)
+
+        added = sum(1 for path, _, _ in changed if path not in known)
+        stats = {'added': added, 'updated': len(records) - added, 'removed': len(removed),
+                 'unchanged': unchanged, 'failed': failed}
+        log("DicomCatalog.scan|Info ==> {}: {}".format(root, stats))
+        return stats
+
+    def patients(self, root):
+        root = os.path.abspath(root)
+        rows = self.connection.execute(
+            'SELECT patient, COUNT(*) FROM dcm_files WHERE root = ? GROUP BY patient ORDER BY patient', (root,))
+        patients = []
+        for patient, num_files in rows:
+            patients.append(patient)
+            log("DicomCatalog.patients|Info: patient <{}> found with {} dcm files".format(
+                os.path.join(root, patient), num_files))
+        log("Patients detected:{}".format(str(len(patients))))
+        return patients
+
+    def series(self, root, patient):
+        # (SeriesInstanceUID, subfolder, number of files), largest series first
+        return self.connection.execute(
+            'SELECT series_uid, subfolder, COUNT(*) AS num_files FROM dcm_files '
+            'WHERE root = ? AND patient = ? AND series_uid IS NOT NULL GROUP BY series_uid, subfolder ORDER BY num_files DESC, subfolder',
+            (os.path.abspath(root), patient)).fetchall()
+
+    def series_files(self, series_uid, root=None, patient=None, subfolder=None):
+        # A series copied into several subfolders is one series per subfolder, as in series()
+        query = 'SELECT path FROM dcm_files WHERE series_uid = ?'
+        args = [series_uid]
+        if root is not None:
+            query += ' AND root = ?'
+            args.append(os.path.abspath(root))
+        if patient is not None:
+            query += ' AND patient = ?'
+            args.append(patient)
+        if subfolder is not None:
+            query += ' AND subfolder = ?'
+            args.append(subfolder.strip('/' + os.sep))
+        return [path for path, in self.connection.execute(query + ' ORDER BY position_z, path', args)]
+
+    def patient_files(self, root, patient, subfolder=None):
+        # Sorted file list of one series of a patient: the largest one, optionally restricted to a subfolder
+        for series_uid, series_subfolder, _ in self.series(root, patient):
+            if subfolder is None or series_subfolder == subfolder.strip('/' + os.sep):
+                return self.series_files(series_uid, root, patient, series_subfolder)
+        return []
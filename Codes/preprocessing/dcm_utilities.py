@@ -1,19 +1,33 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import numpy as np
+import pandas as pd
 import pydicom
+from pydicom.multival import MultiValue
+
+from instrumentation import instrumented, log
 
 
-def load_ct_scan(path):
+def list_dcm_files(path):
     dcm_files = []
     for file in os.listdir(path):
         _, file_extension = os.path.splitext(file)
         if file_extension == ".dcm":
             dcm_files.append(os.path.join(path, file))
+    return dcm_files
+
+
+@instrumented()
+def load_ct_scan(path, dcm_files=None, presorted=False):
+    if dcm_files is None:
+        dcm_files = list_dcm_files(path)
     try:
         slices = [pydicom.read_file(dcm) for dcm in dcm_files]
-        slices.sort(key=lambda x: float(x.ImagePositionPatient[2]))
+        if not presorted:
+            slices.sort(key=lambda x: float(x.ImagePositionPatient[2]))
 
-        print("load_ct_scan|Info ==> loaded", str(len(slices)), "slices from:", path)
+        log("load_ct_scan|Info ==> loaded", str(len(slices)), "slices from:", path)
 
         try:
             slice_thickness = np.abs(slices[0].ImagePositionPatient[2] - slices[1].ImagePositionPatient[2])
@@ -24,454 +38,145 @@ def load_ct_scan(path):
             if slice_thickness > 0.0:
                 s.SliceThickness = slice_thickness
             else:
-                print("load_ct_scan|Error: Invalid slice thickness:", slice_thickness)
+                log("load_ct_scan|Error: Invalid slice thickness:", slice_thickness)
         spacing = np.array([slices[0].SliceThickness] + list(slices[0].PixelSpacing), dtype=np.float32)
         return slices, spacing
     except Exception as e:
-        print("load_ct_scan|Error:", str(e))
+        log("load_ct_scan|Error:", str(e))
 
 
-def get_pixels_hu(slices):
-    image = np.stack([s.pixel_array for s in slices])
-    # Convert to int16 (from sometimes int16),
+@instrumented()
+def get_pixels_hu(slices, out=None):
+    # Convert to int16 (from sometimes int16) while copying each slice into the output volume,
     # should be possible as values should always be low enough (<32k)
-    image = image.astype(np.int16)
-
-    # Set outside-of-scan pixels to 0
-    # The intercept is usually -1024, so air is approximately 0
-    image[image == -2000] = 0
-
-    # Convert to Hounsfield units (HU)
-    for slice_number in range(len(slices)):
-
-        intercept = slices[slice_number].RescaleIntercept
-        slope = slices[slice_number].RescaleSlope
-
-        if slope != 1:
-            image[slice_number] = slope * image[slice_number].astype(np.float64)
-            image[slice_number] = image[slice_number].astype(np.int16)
-
-        image[slice_number] += np.int16(intercept)
-
-    return np.array(image, dtype=np.int16)
-
-
-
-def extract_slice_metadata(slice, delimiter):
-
-    metadata = []
-
-    try:
-        metadata.append(str(slice['SpecificCharacterSet']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['ImageType']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['InstanceCreationDate']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['InstanceCreationTime']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['SOPClassUID']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['SOPInstanceUID']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['StudyDate']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['AcquisitionDate']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['ContentDate']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['AcquisitionDateTime']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['StudyTime']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['AcquisitionTime']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['ContentTime']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['AccessionNumber']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['Modality']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['Manufacturer']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['InstitutionName']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['InstitutionAddress']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['ReferringPhysicianName']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['StationName']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['StudyDescription']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['SeriesDescription']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['InstitutionalDepartmentName']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    # try:
-    #     metadata.append(str(slice['OperatorName']).split(":")[1].strip())
-    # except:
-    #     metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['ManufacturerModelName']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['IrradiationEventUID']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['PatientName']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['PatientID']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['PatientBirthDate']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['PatientSex']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['PatientAge']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['MedicalAlerts']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['ScanOptions']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['SliceThickness']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['KVP']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['SpacingBetweenSlices']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['DataCollectionDiameter']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+    if out is None:
+        out = np.empty((len(slices), int(slices[0].Rows), int(slices[0].Columns)), dtype=np.int16)
+    for slice_number, s in enumerate(slices):
+        out[slice_number] = s.pixel_array
 
-    try:
-        metadata.append(str(slice['SoftwareVersions']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['ProtocolName']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['ReconstructionDiameter']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['GantryDetectorTilt']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['TableHeight']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['RotationDirection']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['ExposureTime']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['XRayTubeCurrent']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['Exposure']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['FilterType']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['ConvolutionKernel']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+    slopes = [s.RescaleSlope for s in slices]
+    intercepts = [s.RescaleIntercept for s in slices]
+    return rescale_to_hu(out, slopes, intercepts)
 
-    try:
-        metadata.append(str(slice['PatientPosition']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['ExposureModulationType']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['EstimatedDoseSaving']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['CTDIvol']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['StudyInstanceUID']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['SeriesInstanceUID']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['StudyID']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['SeriesNumber']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    try:
-        metadata.append(str(slice['AcquisitionNumber']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
 
-    try:
-        metadata.append(str(slice['InstanceNumber']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
-
-    # try:
-    #     metadata.append(str(slice['ImagePosition']).split(":")[1].strip())
-    # except:
-    #     metadata.append("_NO_VAL_")
-    #
-    # try:
-    #     metadata.append(str(slice['ImageOrientation']).split(":")[1].strip())
-    # except:
-    #     metadata.append("_NO_VAL_")
-    #
-    # try:
-    #     metadata.append(str(slice['FrameOfReferenceUID']).split(":")[1].strip())
-    # except:
-    #     metadata.append("_NO_VAL_")
+# Number of slices converted per float64 block when a slope is not 1
+RESCALE_BLOCK_SLICES = 16
 
-    try:
-        metadata.append(str(slice['Laterality']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
 
-    try:
-        metadata.append(str(slice['PositionReferenceIndicator']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+def rescale_to_hu(image, slopes, intercepts, out=None):
+    if out is None:
+        out = image
+    elif out is not image:
+        np.copyto(out, image, casting='unsafe')
 
-    try:
-        metadata.append(str(slice['SliceLocation']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+    # Set outside-of-scan pixels to 0
+    # The intercept is usually -1024, so air is approximately 0
+    out[out == -2000] = 0
+
+    # Convert to Hounsfield units (HU). Slices with a slope of 1 skip the float math entirely,
+    # the others go through a float64 buffer a block of slices at a time.
+    slopes = np.asarray(slopes, dtype=np.float64)
+    scaled = slopes != 1
+    if scaled.any():
+        buffer = np.empty((min(RESCALE_BLOCK_SLICES, len(slopes)),) + out.shape[1:], dtype=np.float64)
+        for start in range(0, len(slopes), RESCALE_BLOCK_SLICES):
+            stop = min(start + RESCALE_BLOCK_SLICES, len(slopes))
+            if not scaled[start:stop].any():
+                continue
+            block = buffer[:stop - start]
+            np.copyto(block, out[start:stop])
+            block *= slopes[start:stop, None, None]
+            if scaled[start:stop].all():
+                np.copyto(out[start:stop], block, casting='unsafe')
+            else:
+                np.copyto(out[start:stop], block, casting='unsafe', where=scaled[start:stop, None, None])
 
-    try:
-        metadata.append(str(slice['ImageComments']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+    intercepts = np.trunc(np.asarray(intercepts, dtype=np.float64)).astype(np.int16)
+    np.add(out, intercepts[:, None, None], out=out)
+    return out
 
-    try:
-        metadata.append(str(slice['SamplesPerPixel']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
 
-    try:
-        metadata.append(str(slice['PhotometricInterpretation']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+def _read_ct_header(dcm):
+    return pydicom.dcmread(dcm, stop_before_pixels=True)
 
-    try:
-        metadata.append(str(slice['Rows']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
 
-    try:
-        metadata.append(str(slice['Columns']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+def _read_pixels(dcm):
+    return pydicom.dcmread(dcm).pixel_array
 
-    try:
-        metadata.append(str(slice['PixelSpacing']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
 
-    try:
-        metadata.append(str(slice['BitsAllocated']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+def _read_pixels_into(volume, index, dcm):
+    volume[index] = pydicom.dcmread(dcm).pixel_array
 
-    try:
-        metadata.append(str(slice['BitsStored']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
 
-    try:
-        metadata.append(str(slice['HighBit']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+def _slice_z(header):
+    return float(header.ImagePositionPatient[2])
 
-    try:
-        metadata.append(str(slice['PixelRepresentation']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
 
-    try:
-        metadata.append(str(slice['WindowCenter']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+def validate_ct_geometry(headers):
+    rows = {int(h.Rows) for h in headers}
+    columns = {int(h.Columns) for h in headers}
+    pixel_spacing = {tuple(float(v) for v in h.PixelSpacing) for h in headers}
+    if len(rows) > 1 or len(columns) > 1:
+        raise ValueError("inconsistent slice matrix sizes: rows {} columns {}".format(sorted(rows), sorted(columns)))
+    if len(pixel_spacing) > 1:
+        raise ValueError("inconsistent PixelSpacing: {}".format(sorted(pixel_spacing)))
 
-    try:
-        metadata.append(str(slice['WindowWidth']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+    z = np.array([_slice_z(h) for h in headers])
+    steps = np.diff(z)
+    if np.any(steps == 0):
+        raise ValueError("duplicate ImagePositionPatient[2] values")
+    if len(steps) > 1 and np.ptp(steps) > 0.01 * np.abs(np.median(steps)):
+        log("validate_ct_geometry|Warn: non-uniform slice spacing in range [{:.3f}; {:.3f}]".format(
+            np.min(steps), np.max(steps)))
 
-    try:
-        metadata.append(str(slice['RescaleIntercept']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
 
-    try:
-        metadata.append(str(slice['RescaleSlope']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+@instrumented()
+def load_ct_volume(path, workers=4, use_processes=False, dcm_files=None, presorted=False, out=None):
+    if dcm_files is None:
+        dcm_files = list_dcm_files(path)
 
-    try:
-        metadata.append(str(slice['LossyImageCompression']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+    # Pass 1: read headers only (pixel data is skipped) to sort and validate the series
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        headers = list(executor.map(_read_ct_header, dcm_files))
+    if not presorted:
+        order = sorted(range(len(headers)), key=lambda i: _slice_z(headers[i]))
+        headers = [headers[i] for i in order]
+        dcm_files = [dcm_files[i] for i in order]
+    validate_ct_geometry(headers)
 
-    try:
-        metadata.append(str(slice['RequestedContrastAgent']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+    log("load_ct_volume|Info ==> loaded", str(len(headers)), "slice headers from:", path)
 
     try:
-        metadata.append(str(slice['PreMedication']).split(":")[1].strip())
+        slice_thickness = np.abs(headers[0].ImagePositionPatient[2] - headers[1].ImagePositionPatient[2])
     except:
-        metadata.append("_NO_VAL_")
+        slice_thickness = np.abs(headers[0].SliceLocation - headers[1].SliceLocation)
+    if slice_thickness <= 0.0:
+        log("load_ct_volume|Error: Invalid slice thickness:", slice_thickness)
+        slice_thickness = headers[0].SliceThickness
+    spacing = np.array([slice_thickness] + list(headers[0].PixelSpacing), dtype=np.float32)
 
-    try:
-        metadata.append(str(slice['PerformedProcedureStepID']).split(":")[1].strip())
-    except:
-        metadata.append("_NO_VAL_")
+    # Pass 2: decode pixel data straight into one preallocated volume
+    shape = (len(headers), int(headers[0].Rows), int(headers[0].Columns))
+    if out is None:
+        out = np.empty(shape, dtype=np.int16)
+    elif out.shape != shape or out.dtype != np.int16:
+        raise ValueError("output buffer must be int16 with shape {}".format(shape))
+    volume = out
+    if use_processes:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(dcm_files) // (4 * workers))
+            for index, pixels in enumerate(executor.map(_read_pixels, dcm_files, chunksize=chunksize)):
+                volume[index] = pixels
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_read_pixels_into, [volume] * len(dcm_files), range(len(dcm_files)), dcm_files))
 
-    return delimiter.join(metadata)
+    slopes = [h.RescaleSlope for h in headers]
+    intercepts = [h.RescaleIntercept for h in headers]
+    volume = rescale_to_hu(volume, slopes, intercepts)
+    log("load_ct_volume|Info ==> decoded volume", str(volume.shape), "with", str(workers),
+        "process" if use_processes else "thread", "workers")
+    return volume, spacing
 
 
 METADATA_HEADER = ['dcm_file',
@@ -555,16 +260,92 @@ METADATA_HEADER = ['dcm_file',
                    'PerformedProcedureStepID']
 
 
+METADATA_TAGS = METADATA_HEADER[1:]
+
+METADATA_NO_VALUE = "_NO_VAL_"
+
+_METADATA_FLOAT_VRS = ('DS', 'FL', 'FD')
+_METADATA_INT_VRS = ('IS', 'SS', 'US', 'SL', 'UL', 'SV', 'UV')
+
+
+def metadata_value(element):
+    value = element.value
+    if value is None or value == '':
+        return None
+    if isinstance(value, (list, tuple, MultiValue)):
+        # Multi-valued elements keep the DICOM backslash separator
+        return "\\".join(str(v) for v in value)
+    if element.VR in _METADATA_FLOAT_VRS:
+        return float(value)
+    if element.VR in _METADATA_INT_VRS:
+        return int(value)
+    if isinstance(value, bytes):
+        return value.decode('ascii', errors='replace').strip()
+    return str(value).strip()
+
+
+def read_slice_metadata(dcm_file, tags=METADATA_TAGS):
+    # Only the requested tags are parsed and reading stops before the pixel data
+    slice = pydicom.dcmread(dcm_file, stop_before_pixels=True, specific_tags=list(tags))
+    row = {'dcm_file': dcm_file}
+    for tag in tags:
+        row[tag] = metadata_value(slice[tag]) if tag in slice else None
+    return row
+
+
+def read_scanner(path, dcm_files=None):
+    # "Manufacturer ManufacturerModelName" from the first slice header, to group timings by scanner
+    dcm_files = dcm_files if dcm_files is not None else list_dcm_files(path)
+    if not dcm_files:
+        return None
+    row = read_slice_metadata(dcm_files[0], ['Manufacturer', 'ManufacturerModelName'])
+    return ' '.join(str(row[tag]) for tag in ('Manufacturer', 'ManufacturerModelName') if row[tag]) or None
+
+
+def extract_slice_metadata(slice, delimiter):
+    metadata = []
+    for tag in METADATA_TAGS:
+        value = metadata_value(slice[tag]) if tag in slice else None
+        metadata.append(METADATA_NO_VALUE if value is None else str(value))
+    return delimiter.join(metadata)
+
+
 def save_metadata(path, log_fh, delimiter):
-    dcm_files = []
-    for file in os.listdir(path):
-        _, file_extension = os.path.splitext(file)
-        if file_extension == ".dcm":
-            dcm_files.append(os.path.join(path, file))
+    dcm_files = list_dcm_files(path)
     try:
         for dcm in dcm_files:
-            slice = pydicom.read_file(dcm)
+            slice = pydicom.dcmread(dcm, stop_before_pixels=True, specific_tags=METADATA_TAGS)
             slice_metadata = extract_slice_metadata(slice, delimiter)
             log_fh.write(dcm + ";" + slice_metadata + "\n")
     except:
-        print("save_metadata error")
+        log("save_metadata|Error: could not read", path)
+
+
+def _patient_metadata(path, tags=METADATA_TAGS):
+    rows = []
+    for dcm in list_dcm_files(path):
+        try:
+            rows.append(read_slice_metadata(dcm, tags))
+        except Exception as e:
+            log("collect_metadata|Error:", dcm, str(e))
+    return rows
+
+
+def collect_metadata(patient_dirs, out_file=None, workers=4, use_processes=True, tags=METADATA_TAGS):
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    rows = []
+    with executor_class(max_workers=workers) as executor:
+        for path, patient_rows in zip(patient_dirs, executor.map(_patient_metadata, patient_dirs,
+                                                                   [tags] * len(patient_dirs))):
+            log("collect_metadata|Info ==> {} files from: {}".format(len(patient_rows), path))
+            rows.extend(patient_rows)
+
+    # One typed column per tag: integers, floats and strings become nullable pandas dtypes
+    df_metadata = pd.DataFrame.from_records(rows, columns=['dcm_file'] + list(tags)).convert_dtypes()
+    if out_file is not None:
+        if out_file.endswith('.parquet'):
+            df_metadata.to_parquet(out_file, index=False)
+        else:
+            df_metadata.to_csv(out_file, index=False)
+        log("collect_metadata|Info ==> saved {} rows to: {}".format(len(df_metadata), out_file))
+    return df_metadata
@@ -0,0 +1,239 @@
+import argparse
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows: no peak RSS figures
+    resource = None
+
+# Print-based progress messages are shown from this level up. The level and the stage log file are kept in
+# the environment so that worker processes started by pipeline.py inherit them.
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warn': 30, 'error': 40, 'quiet': 100}
+LOG_LEVEL_ENV = 'COVIDCTNET_LOG_LEVEL'
+STAGE_LOG_ENV = 'COVIDCTNET_STAGE_LOG'
+STAGE_PERCENTILES = (50, 90, 99)
+# "func|Error: ...", "Class.method|Warn ==> ...", "func|Info ==> ..."
+_LEVEL_TAG = re.compile(r'\s*[\w.\[\]]+\|(Debug|Info|Warn|Error)')
+
+# Patient ID and tags of the stage records; per thread (and per context), so that a worker thread such as
+# the SliceBatcher does not pick up the patient the main thread is working on
+_patient = contextvars.ContextVar('patient', default=None)
+_local = threading.local()
+
+
+def set_log_level(level):
+    if level not in LOG_LEVELS:
+        raise ValueError("unknown log level {!r}, expected one of {}".format(level, list(LOG_LEVELS)))
+    os.environ[LOG_LEVEL_ENV] = level
+
+
+def log_level():
+    return LOG_LEVELS.get(os.environ.get(LOG_LEVEL_ENV, 'info'), LOG_LEVELS['info'])
+
+
+def _message_level(args):
+    # Only the "func|Level" tag at the start of the first argument counts, not paths or values later on;
+    # untagged messages are Info
+    match = _LEVEL_TAG.match(str(args[0])) if args else None
+    if match is None:
+        return LOG_LEVELS['info']
+    return LOG_LEVELS[match.group(1).lower()]
+
+
+def log(*args, **kwargs):
+    # Drop-in for print(): the level comes from the "func|Error" / "func|Warn" / "func|Info" message itself
+    if _message_level(args) >= log_level():
+        print(*args, **kwargs)
+
+
+def set_stage_log(path):
+    # JSON lines file the stage records are appended to; None turns recording off
+    if path is None:
+        os.environ.pop(STAGE_LOG_ENV, None)
+    else:
+        os.environ[STAGE_LOG_ENV] = os.path.abspath(path)
+
+
+@contextlib.contextmanager
+def patient_context(patient_id, **tags):
+    # Stage records inside the block carry the patient ID and tags (e.g. scanner='SIEMENS Emotion 16')
+    patient = dict(tags, patient=patient_id)
+    token = _patient.set(patient)
+    try:
+        yield patient
+    finally:
+        _patient.reset(token)
+
+
+def tag_patient(**tags):
+    # Adds tags to the current patient once they are known, e.g. the scanner read from the first header
+    patient = _patient.get()
+    if patient is not None:
+        patient.update(tags)
+
+
+def describe(value):
+    # Shape/dtype/size of an array, or of the arrays inside a tuple or list result
+    if isinstance(value, np.ndarray):
+        return {'shape': list(value.shape), 'dtype': value.dtype.name, 'nbytes': int(value.nbytes)}
+    if isinstance(value, (tuple, list)):
+        described = [describe(v) for v in value[:4]]
+        return [d for d in described if d is not None] or None
+    return None
+
+
+def _io_counters():
+    # Bytes read and written by this process so far, from /proc (Linux only)
+    try:
+        with open('/proc/self/io') as fh:
+            counters = dict(line.split(':') for line in fh)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _delta(after, before):
+    return None if after is None or before is None else after - before
+
+
+@contextlib.contextmanager
+def stage(name, inputs=None, **fields):
+    # Times the block and appends one record to the stage log: wall and CPU seconds, input/output arrays,
+    # bytes read/written and the growth of the process peak RSS. Set record['output'] inside the block to
+    # describe the result. Without a stage log the record is built but not written.
+    stack = _local.__dict__.setdefault('stages', [])
+    record = dict(_patient.get() or {}, stage=name, parent=stack[-1] if stack else None, **fields)
+    if inputs is not None:
+        record['input'] = describe(inputs)
+    read_before, written_before = _io_counters()
+    rss_before = _peak_rss()
+    cpu_before = time.process_time()
+    start = time.perf_counter()
+    stack.append(name)
+    status = 'ok'
+    try:
+        yield record
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        stack.pop()
+        record['wall_seconds'] = time.perf_counter() - start
+        record['cpu_seconds'] = time.process_time() - cpu_before
+        read_after, written_after = _io_counters()
+        record['bytes_read'] = _delta(read_after, read_before)
+        record['bytes_written'] = _delta(written_after, written_before)
+        record['peak_rss_delta'] = _delta(_peak_rss(), rss_before)
+        record['status'] = status
+        # Tags added inside the block (tag_patient) also reach the stage that encloses them
+        record.update((key, value) for key, value in (_patient.get() or {}).items() if key not in fields)
+        if isinstance(record.get('output'), np.ndarray):
+            record['output'] = describe(record['output'])
+        _write_record(record)
+
+
+def _write_record(record):
+    path = os.environ.get(STAGE_LOG_ENV)
+    if not path:
+        return
+    record.update(pid=os.getpid(), host=socket.gethostname(), time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    line = json.dumps(record, default=str) + '\n'
+    # One write per record in append mode, so records from parallel workers do not interleave
+    with open(path, 'a') as fh:
+        fh.write(line)
+
+
+def instrumented(name=None):
+    # Decorator: runs the function inside stage(), with its first argument as input and its result as output
+    def decorator(fn):
+        stage_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name, inputs=args[0] if args else None) as record:
+                result = fn(*args, **kwargs)
+                record['output'] = describe(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def read_stage_records(paths):
+    records = []
+    for path in [paths] if isinstance(paths, str) else paths:
+        with open(path) as fh:
+            records.extend(json.loads(line) for line in fh if line.strip())
+    return records
+
+
+def summarize_stages(records, by=('stage',), percentiles=STAGE_PERCENTILES, top_level=False):
+    # Per-group count and wall/CPU time percentiles, mean peak RSS growth and total bytes read/written.
+    # by: record fields to group on, e.g. ('stage', 'scanner'); top_level=True skips nested stages.
+    groups = {}
+    for record in records:
+        if top_level and record.get('parent') is not None:
+            continue
+        groups.setdefault(tuple(record.get(field) for field in by), []).append(record)
+    summary = {}
+    for key, group in sorted(groups.items(), key=lambda item: [str(k) for k in item[0]]):
+        wall = np.array([r['wall_seconds'] for r in group])
+        cpu = np.array([r['cpu_seconds'] for r in group])
+        rss = [r['peak_rss_delta'] for r in group if r.get('peak_rss_delta') is not None]
+        stats = {'count': len(group), 'failed': sum(r.get('status') == 'failed' for r in group),
+                 'wall_total': float(wall.sum()), 'cpu_total': float(cpu.sum()),
+                 'peak_rss_delta_mean_mb': float(np.mean(rss)) / 2 ** 20 if rss else None,
+                 'bytes_read': sum(r.get('bytes_read') or 0 for r in group),
+                 'bytes_written': sum(r.get('bytes_written') or 0 for r in group)}
+        for q, wall_q, cpu_q in zip(percentiles, np.percentile(wall, percentiles), np.percentile(cpu, percentiles)):
+            stats['wall_p{}'.format(q)] = float(wall_q)
+            stats['cpu_p{}'.format(q)] = float(cpu_q)
+        summary[key] = stats
+    return summary
+
+
+def print_stage_summary(summary, by=('stage',), percentiles=STAGE_PERCENTILES):
+    columns = ['wall_p{}'.format(q) for q in percentiles] + ['cpu_p{}'.format(q) for q in percentiles]
+    print("{:<40} {:>6} {}{:>10} {:>10} {:>10}".format(
+        '/'.join(by), 'count', ''.join('{:>10}'.format(c) for c in columns), 'wall sum', 'read MB', 'write MB'))
+    for key, stats in summary.items():
+        print("{:<40} {:>6} {}{:10.2f} {:10.1f} {:10.1f}".format(
+            '/'.join(str(k) for k in key)[:40], stats['count'], ''.join('{:10.3f}'.format(stats[c]) for c in columns),
+            stats['wall_total'], stats['bytes_read'] / 2 ** 20, stats['bytes_written'] / 2 ** 20))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-stage percentiles from stage log files")
+    parser.add_argument('stage_logs', nargs='+', help="JSON lines files written with --stage-log")
+    parser.add_argument('--by', nargs='+', default=['stage'], help="record fields to group by, e.g. stage scanner")
+    parser.add_argument('--top-level', action='store_true', help="skip stages nested inside other stages")
+    parser.add_argument('--json', help="also write the summary to this file")
+    args = parser.parse_args(argv)
+
+    summary = summarize_stages(read_stage_records(args.stage_logs), args.by, top_level=args.top_level)
+    print_stage_summary(summary, args.by)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump([dict(zip(args.by, key), **stats) for key, stats in summary.items()], fh, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
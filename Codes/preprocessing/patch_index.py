@@ -0,0 +1,201 @@
+import collections
+import os
+
+import numpy as np
+
+from instrumentation import log
+from volume_store import CTV_EXTENSION, open_volume, decode_normalized, storage_scale
+
+# One record per patch: which volume it comes from, its origin and its shape. Patches are
+# sliced from the preprocessed volumes on demand instead of being written out as copies.
+PATCH_RECORD_DTYPE = np.dtype([('volume', '<i4'),
+                               ('d', '<i4'), ('h', '<i4'), ('w', '<i4'),
+                               ('dd', '<i2'), ('hh', '<i2'), ('ww', '<i2')])
+
+# Memory-mapped volumes kept open at a time while slicing batches; each one holds a file descriptor
+PATCH_SOURCE_CACHE = 16
+
+# Class labels used by the training notebooks, from the first letter of the exported file names
+PATCH_LABELS = {'H': 0, 'C': 1, 'P': 2}
+
+
+def volume_shape(path):
+    # Shape from the file header only
+    if path.endswith(CTV_EXTENSION):
+        return open_volume(path).shape
+    return np.load(path, mmap_mode='r').shape
+
+
+def open_patch_source(path):
+    # Array-like that supports [d:d1, h:h1, w:w1] without reading the whole volume
+    if path.endswith(CTV_EXTENSION):
+        volume = open_volume(path)
+        return volume.memmap() if volume.compression is None else volume
+    return np.load(path, mmap_mode='r')
+
+
+def _open_scaled_source(path):
+    # open_patch_source() and volume_scale() from a single open of the file
+    if path.endswith(CTV_EXTENSION):
+        volume = open_volume(path)
+        scale = volume.attrs.get('scale') or storage_scale(volume.dtype)
+        return (volume.memmap() if volume.compression is None else volume), scale
+    source = np.load(path, mmap_mode='r')
+    return source, storage_scale(source.dtype)
+
+
+def volume_scale(path):
+    # Quantization scale of a stored volume (see STORAGE_POLICIES), None for float volumes
+    if path.endswith(CTV_EXTENSION):
+        volume = open_volume(path)
+        return volume.attrs.get('scale') or storage_scale(volume.dtype)
+    return storage_scale(np.load(path, mmap_mode='r').dtype)
+
+
+class PatchSourceCache:
+    # The most recently used open_patch_source() sources with their scales, at most `size` at a time.
+    # Evicted memmaps are closed once nothing references them anymore.
+
+    def __init__(self, size=PATCH_SOURCE_CACHE):
+        self.size = size
+        self._sources = collections.OrderedDict()
+
+    def get(self, path):
+        if path in self._sources:
+            self._sources.move_to_end(path)
+        else:
+            self._sources[path] = _open_scaled_source(path)
+            while len(self._sources) > self.size:
+                self._sources.popitem(last=False)
+        return self._sources[path]
+
+
+def normal_patch_records(shape, patch_shape, stride, volume=0):
+    # Same windows as export_normal_patches: origins range(0, n - p, s) along each axis
+    origins = [np.arange(0, max(0, n - p), s) for n, p, s in zip(shape, patch_shape, stride)]
+    d, h, w = np.meshgrid(*origins, indexing='ij')
+    records = np.empty(d.size, dtype=PATCH_RECORD_DTYPE)
+    records['volume'] = volume
+    records['d'], records['h'], records['w'] = d.ravel(), h.ravel(), w.ravel()
+    records['dd'], records['hh'], records['ww'] = patch_shape
+    return records
+
+
+def centered_patch_records(shape, centers, patch_shape, volume=0):
+    # Patches centered on (z, y, x) voxel coordinates, as in export_centered_patches. Patches reaching
+    # outside the volume are kept; iter_patch_batches pads them as gather_centered_patches does
+    centers = np.rint(np.asarray(centers, dtype=np.float64).reshape(-1, 3)).astype(np.int64)
+    origins = centers - np.asarray(patch_shape) // 2
+    records = np.empty(len(origins), dtype=PATCH_RECORD_DTYPE)
+    records['volume'] = volume
+    records['d'], records['h'], records['w'] = origins.T
+    records['dd'], records['hh'], records['ww'] = patch_shape
+    return records
+
+
+class PatchIndex:
+
+    def __init__(self, volumes=None, shapes=None, labels=None, records=None):
+        self.volumes = list(volumes) if volumes is not None else []
+        self.shapes = [tuple(int(n) for n in shape) for shape in shapes] if shapes is not None else []
+        self.labels = list(labels) if labels is not None else []
+        self.records = records if records is not None else np.empty(0, dtype=PATCH_RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def add_volume(self, path, label=None, shape=None):
+        if label is None:
+            label = PATCH_LABELS.get(os.path.basename(path)[:1], -1)
+        self.volumes.append(path)
+        self.shapes.append(tuple(int(n) for n in (shape if shape is not None else volume_shape(path))))
+        self.labels.append(int(label))
+        return len(self.volumes) - 1
+
+    def add_records(self, records):
+        self.records = np.concatenate([self.records, records])
+
+    def normal_patches(self, patch_shape, stride):
+        # New index over the same volumes with a different patch shape or stride, no re-export needed
+        records = [normal_patch_records(shape, patch_shape, stride, i) for i, shape in enumerate(self.shapes)]
+        return PatchIndex(self.volumes, self.shapes, self.labels,
+                          np.concatenate(records) if records else None)
+
+    def patch_labels(self):
+        return np.asarray(self.labels, dtype=np.int64)[self.records['volume']]
+
+    def nbytes_materialized(self, itemsize=8):
+        # Size the same patches would take as exported float64 patch files
+        return int(np.sum(self.records['dd'].astype(np.int64) * self.records['hh'] * self.records['ww'])) * itemsize
+
+    def save(self, path):
+        np.savez(path, volumes=np.array(self.volumes, dtype=str), shapes=np.array(self.shapes, dtype=np.int64),
+                 labels=np.array(self.labels, dtype=np.int64), records=self.records)
+        log("PatchIndex.save|Info ==> {} patches from {} volumes to: {}".format(
+            len(self.records), len(self.volumes), path))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['volumes'].tolist(), data['shapes'].tolist(), data['labels'].tolist(),
+                       data['records'])
+
+
+def build_normal_patch_index(volume_files, patch_shape, stride, labels=None):
+    # Index of the windows export_normal_patches would write for each volume
+    index = PatchIndex()
+    for i, path in enumerate(volume_files):
+        volume = index.add_volume(path, None if labels is None else labels[i])
+        index.add_records(normal_patch_records(index.shapes[volume], patch_shape, stride, volume))
+    log("build_normal_patch_index|Info ==> {} patches from {} volumes, {:.1f} MB as patch files".format(
+        len(index), len(index.volumes), index.nbytes_materialized() / 2 ** 20))
+    return index
+
+
+def _read_edge_patch(source, shape, origin, patch_shape):
+    # Patch whose window reaches outside the volume, voxels outside repeating the nearest edge voxel.
+    # Only the part of the window inside the volume is read.
+    index = [np.clip(np.arange(o, o + p), 0, n - 1) for o, p, n in zip(origin, patch_shape, shape)]
+    window = np.asarray(source[index[0][0]:index[0][-1] + 1, index[1][0]:index[1][-1] + 1,
+                               index[2][0]:index[2][-1] + 1])
+    return window[np.ix_(index[0] - index[0][0], index[1] - index[1][0], index[2] - index[2][0])]
+
+
+def iter_patch_batches(index, batch_size=32, shuffle=True, seed=None, dtype=np.float32, drop_last=False,
+                       pad_mode='edge', cval=0):
+    # Yields (patches, labels) batches sliced from memory-mapped volumes. Within a batch the reads
+    # are ordered by volume and depth so each volume is visited once; the batch keeps the shuffled order.
+    # Quantized volumes are decoded to [0, 1] with their stored scale. Patches reaching outside the volume
+    # (centered_patch_records) are padded with pad_mode and cval as in gather_centered_patches.
+    if pad_mode not in ('edge', 'constant'):
+        raise ValueError("unknown pad_mode {!r}, expected 'edge' or 'constant'".format(pad_mode))
+    records = index.records
+    if len(records) == 0:
+        return
+    patch_shape = (int(records['dd'][0]), int(records['hh'][0]), int(records['ww'][0]))
+    if not (np.all(records['dd'] == patch_shape[0]) and np.all(records['hh'] == patch_shape[1]) and
+            np.all(records['ww'] == patch_shape[2])):
+        raise ValueError("iter_patch_batches needs an index with a single patch shape")
+    order = np.random.default_rng(seed).permutation(len(records)) if shuffle else np.arange(len(records))
+    labels = index.patch_labels()
+    sources = PatchSourceCache()
+    dd, hh, ww = patch_shape
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        if drop_last and len(batch) < batch_size:
+            break
+        patches = np.empty((len(batch),) + patch_shape, dtype=dtype)
+        batch_records = records[batch]
+        for i in np.lexsort((batch_records['d'], batch_records['volume'])):
+            volume, d, h, w = (int(batch_records[name][i]) for name in ('volume', 'd', 'h', 'w'))
+            source, scale = sources.get(index.volumes[volume])
+            shape = index.shapes[volume]
+            if d >= 0 and h >= 0 and w >= 0 and d + dd <= shape[0] and h + hh <= shape[1] and w + ww <= shape[2]:
+                patches[i] = decode_normalized(source[d:d + dd, h:h + hh, w:w + ww], scale, dtype)
+                continue
+            patches[i] = decode_normalized(_read_edge_patch(source, shape, (d, h, w), patch_shape), scale, dtype)
+            if pad_mode == 'constant':
+                inside = [(np.arange(o, o + p) >= 0) & (np.arange(o, o + p) < n)
+                          for o, p, n in zip((d, h, w), patch_shape, shape)]
+                patches[i][~(inside[0][:, None, None] & inside[1][None, :, None] & inside[2][None, None, :])] = cval
+        yield patches, labels[batch]
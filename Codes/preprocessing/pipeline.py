@@ -0,0 +1,301 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dcm_catalog import DicomCatalog
+from dcm_utilities import load_ct_volume, read_scanner
+from instrumentation import LOG_LEVELS, log, patient_context, set_log_level, set_stage_log, stage, tag_patient
+from utilities import build_patient_list, resample_ct_pixels, normalize_hu, compute_lung_mask, apply_lung_mask
+from utilities import crop_ct_lungs, export_normal_slices, truncate_hu
+import utilities
+from stage_cache import STAGE_CACHE_BYTES, StageCache, array_digest, stage_key, merge_stage_stats
+from volume_store import CTV_EXTENSION, STORAGE_POLICIES, save_ct_pixels, load_ct_pixels, storage_dtype
+
+# Append-only record of finished patients, one JSON object per line; the last line of a patient wins
+PIPELINE_MANIFEST = 'manifest.jsonl'
+
+STEP2_DEFAULTS = {'normal_patch_shape': [3, 128, 128],
+                  'stride': [17, 19, 21],
+                  'new_spacing': [1, 1, 1],
+                  'lung_mask_threshold': -350,
+                  'apply_lungs_segmentation': False,
+                  'apply_cropping': False,
+                  'store_format': 'npy',
+                  'storage_policy': 'float64',  # dtype of the normalized slices, see STORAGE_POLICIES
+                  'cache_dir': None,  # stage cache for resampled, normalized and mask volumes
+                  'cache_bytes': STAGE_CACHE_BYTES}
+
+
+def read_manifest(output_dir):
+    records = {}
+    manifest = os.path.join(output_dir, PIPELINE_MANIFEST)
+    if os.path.isfile(manifest):
+        with open(manifest) as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # last line of a killed run
+                    continue
+                records[record['patient']] = record
+    return records
+
+
+def _append_manifest(output_dir, record):
+    with open(os.path.join(output_dir, PIPELINE_MANIFEST), 'a') as fh:
+        fh.write(json.dumps(record) + '\n')
+
+
+def _is_done(record):
+    return record is not None and record['status'] == 'done' and all(os.path.isfile(f) for f in record['outputs'])
+
+
+@contextlib.contextmanager
+def atomic_output_dir(output_dir, name):
+    # Outputs are written to a private directory next to their destination and renamed into place
+    # only once the whole patient succeeded, so a killed run never leaves partial files under final names
+    tmp_dir = os.path.join(output_dir, '.tmp-{}-{}'.format(name, os.getpid()))
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        yield tmp_dir + os.sep
+        for file_name in sorted(os.listdir(tmp_dir)):
+            os.replace(os.path.join(tmp_dir, file_name), os.path.join(output_dir, file_name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # owned by another user
+        return True
+    return True
+
+
+def remove_stale_tmp_dirs(output_dir):
+    # Private directories of atomic_output_dir left behind by killed runs. Other runs may be writing into the
+    # same output folder (e.g. H, C and P at once), so only directories whose process is gone are removed.
+    for tmp_dir in glob.glob(os.path.join(output_dir, '.tmp-*')):
+        pid = os.path.basename(tmp_dir).rsplit('-', 1)[-1]
+        if pid.isdigit() and not _pid_alive(int(pid)):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def extract_patient(patient, input_dir, output_dir, prefix, subfolder='', store_format='npy', io_workers=4,
+                    dcm_files=None):
+    # Step 1 for one patient: DICOM series -> HU int16 volume + spacing.
+    # dcm_files: the series' files sorted by slice position (DicomCatalog.patient_files), else the folder is listed
+    name = prefix + str(patient)
+    tag_patient(scanner=read_scanner(input_dir + patient + subfolder, dcm_files))
+    ct_pixels, ct_spacing = load_ct_volume(input_dir + patient + subfolder, workers=io_workers, dcm_files=dcm_files,
+                                           presorted=dcm_files is not None)
+    with atomic_output_dir(output_dir, name) as tmp_dir:
+        outputs = save_ct_pixels(tmp_dir, name, ct_pixels, ct_spacing, label=prefix.rstrip('_'),
+                                 store_format=store_format)
+    return [os.path.join(output_dir, os.path.basename(f)) for f in outputs]
+
+
+def truncated_lung_mask(ct_resampled_hu, threshold=-350):
+    # As the step-2 notebook: the mask of the truncated HU volume, bone above MAX_BOUND_HU counting as air
+    return compute_lung_mask(truncate_hu(ct_resampled_hu.copy()), threshold=threshold)
+
+
+def preprocess_stage_keys(ct_pixels_hu, ct_spacing, config):
+    # StageCache keys of the step-2 stages, chained from the digest of the HU volume
+    pixels_key = stage_key('pixels', array_digest(ct_pixels_hu), spacing=ct_spacing)
+    resample_key = stage_key('resample', pixels_key, new_spacing=config['new_spacing'])
+    return {'resample': resample_key,
+            'normalize': stage_key('normalize', resample_key, min_bound_hu=utilities.MIN_BOUND_HU,
+                                   max_bound_hu=utilities.MAX_BOUND_HU, dtype=config['storage_policy']),
+            'lung_mask': stage_key('lung_mask', resample_key, threshold=config['lung_mask_threshold'],
+                                   min_bound_hu=utilities.MIN_BOUND_HU, max_bound_hu=utilities.MAX_BOUND_HU)}
+
+
+def preprocess_patient(patient_id, in_path, out_path, patch_npy_prefix, config=None):
+    # Step 2 for one patient: resample -> truncate/normalize -> optional lung mask and crop -> slices.
+    # With config['cache_dir'] set, resampling, normalization and the lung mask are looked up by a key
+    # chained from the HU volume digest and each stage's parameters, so changing only the export settings
+    # (lung segmentation, cropping, store format) reuses them.
+    config = dict(STEP2_DEFAULTS, **(config or {}))
+    cache = StageCache(config['cache_dir'], config['cache_bytes'])
+    ct_pixels_hu, ct_spacing, _ = load_ct_pixels(in_path, patient_id)
+    if cache.cache_dir is not None:
+        keys = preprocess_stage_keys(ct_pixels_hu, ct_spacing, config)
+    else:  # no cache: skip hashing the HU volume
+        keys = dict.fromkeys(('resample', 'normalize', 'lung_mask'))
+
+    ct_resampled_hu = cache.cached('resample', keys['resample'], resample_ct_pixels, ct_pixels_hu, ct_spacing,
+                                   config['new_spacing'])
+    ct_norm = cache.cached('normalize', keys['normalize'], normalize_hu, ct_resampled_hu,
+                           storage_dtype(config['storage_policy']))
+    if config['apply_lungs_segmentation'] or config['apply_cropping']:
+        lung_mask = cache.cached('lung_mask', keys['lung_mask'], truncated_lung_mask, ct_resampled_hu,
+                                 threshold=config['lung_mask_threshold'])
+        if config['apply_lungs_segmentation']:
+            ct_norm = apply_lung_mask(ct_norm, lung_mask)
+        if config['apply_cropping']:
+            ct_norm = crop_ct_lungs(ct_norm, lung_mask, margin=32)
+    with atomic_output_dir(out_path, patient_id) as tmp_dir:
+        export_normal_slices(ct_norm, config['normal_patch_shape'], config['stride'], tmp_dir, patch_npy_prefix,
+                             patient_id[2:], store_format=config['store_format'], policy=config['storage_policy'])
+        outputs = [os.path.join(out_path, f) for f in sorted(os.listdir(tmp_dir))]
+    if not outputs:
+        raise ValueError("no slices exported for " + patient_id)
+    cache.summary()
+    return {'outputs': outputs, 'cache': cache.stats}
+
+
+def _run_task(fn, patient, args, kwargs, verbose):
+    start = time.perf_counter()
+    captured = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(sys.stdout if verbose else captured), patient_context(patient), stage(fn.__name__):
+            result = fn(*args, **kwargs)
+        # fn returns its output files, or a dict with 'outputs' and extra fields for the manifest
+        record = dict(result) if isinstance(result, dict) else {'outputs': result}
+        record.update(patient=patient, status='done')
+    except Exception as e:
+        record = {'patient': patient, 'status': 'failed', 'error': '{}: {}'.format(type(e).__name__, e),
+                  'outputs': []}
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    record['finished'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    return record
+
+
+def run_pipeline(tasks, output_dir, workers=4, overwrite=False, retry_failed=True, verbose=False):
+    # tasks: [(patient, fn, args, kwargs)]; fn must be importable (module level) to run in worker processes
+    os.makedirs(output_dir, exist_ok=True)
+    remove_stale_tmp_dirs(output_dir)
+    manifest = read_manifest(output_dir)
+    pending = []
+    for patient, fn, args, kwargs in tasks:
+        record = manifest.get(patient)
+        if not overwrite and (_is_done(record) or (not retry_failed and record and record['status'] == 'failed')):
+            continue
+        pending.append((patient, fn, args, kwargs))
+    log("run_pipeline|Info ==> {} patients, {} skipped (done or failed), {} to run on {} workers".format(
+        len(tasks), len(tasks) - len(pending), len(pending), workers))
+
+    stats = {'done': 0, 'failed': 0, 'skipped': len(tasks) - len(pending)}
+    cache_stats = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_task, fn, patient, args, kwargs, verbose)
+                   for patient, fn, args, kwargs in pending]
+        for num_finished, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+            _append_manifest(output_dir, record)
+            stats[record['status']] += 1
+            merge_stage_stats(cache_stats, record.get('cache', {}))
+            elapsed = time.perf_counter() - start
+            eta = elapsed / num_finished * (len(pending) - num_finished)
+            log("run_pipeline|Info ==> [{}/{}] {} {} {:.1f}s elapsed {:.0f}s eta {:.0f}s{}".format(
+                num_finished, len(pending), record['status'], record['patient'], record['seconds'], elapsed, eta,
+                "" if record['status'] == 'done' else " -- " + record['error']))
+    log("run_pipeline|Info ==> finished:", stats)
+    if cache_stats:
+        stats['cache'] = cache_stats
+        for stage, stage_stats in sorted(cache_stats.items()):
+            log("run_pipeline|Info ==> cache {:<12} hits {} misses {} evictions {}".format(
+                stage, stage_stats['hits'], stage_stats['misses'], stage_stats['evictions']))
+    return stats
+
+
+def extract_tasks(lst_patients, input_dir, output_dir, prefix="E", subfolder='', store_format='npy', io_workers=1,
+                  catalog=None):
+    # With a DicomCatalog the file list of each patient comes from the index: the largest series, or the
+    # largest one in subfolder if given, so no per-class subfolder needs to be known
+    tasks = []
+    for p in sorted(lst_patients):
+        kwargs = {}
+        if catalog is not None:
+            kwargs['dcm_files'] = catalog.patient_files(input_dir, p, subfolder or None)
+            if not kwargs['dcm_files']:
+                log("extract_tasks|Warn: no series found for patient", p)
+                continue
+        tasks.append((prefix + str(p), extract_patient,
+                      (p, input_dir, output_dir, prefix, '' if catalog is not None else subfolder, store_format,
+                       io_workers), kwargs))
+    return tasks
+
+
+def preprocess_tasks(in_path, out_path, patient_type, config=None):
+    # Patients are the step-1 outputs <type>_<patient>_ct-pixels.(npy|ctv) found in in_path
+    suffix = "_ct-pixels"
+    files = glob.glob(in_path + patient_type + "_*" + suffix + ".npy") + \
+        glob.glob(in_path + patient_type + "_*" + suffix + CTV_EXTENSION)
+    patient_ids = sorted({os.path.basename(f).rsplit(suffix, 1)[0] for f in files})
+    return [(patient_id, preprocess_patient,
+             (patient_id, in_path, out_path, patient_type + "_" + str(num_patient).zfill(4), config), {})
+            for num_patient, patient_id in enumerate(patient_ids, 1)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run preprocessing step 1 or 2 for many patients in parallel")
+    subparsers = parser.add_subparsers(dest='step', required=True)
+
+    extract = subparsers.add_parser('extract', help="step 1: DICOM folders -> HU volumes")
+    extract.add_argument('input_dir', help="folder with one DICOM folder per patient")
+    extract.add_argument('output_dir')
+    extract.add_argument('--prefix', default='E', help="output name prefix, e.g. H_ or CPCR_")
+    extract.add_argument('--subfolder', default='', help="series subfolder inside each patient, e.g. /SR_3")
+    extract.add_argument('--io-workers', type=int, default=1, help="threads reading DICOM files per patient")
+    extract.add_argument('--catalog', help="DicomCatalog database: input_dir is rescanned incrementally and each "
+                                           "patient's largest series (in --subfolder if given) is read from it")
+
+    preprocess = subparsers.add_parser('preprocess', help="step 2: HU volumes -> normalized slices")
+    preprocess.add_argument('input_dir', help="step 1 output folder")
+    preprocess.add_argument('output_dir')
+    preprocess.add_argument('--patient-type', required=True, help="step 1 prefix without '_', e.g. H")
+    preprocess.add_argument('--segment', action='store_true', help="apply the lung mask")
+    preprocess.add_argument('--crop', action='store_true', help="crop to the lungs")
+    preprocess.add_argument('--cache-dir', help="stage cache folder, shared between runs")
+    preprocess.add_argument('--cache-gb', type=float, default=STAGE_CACHE_BYTES / 2 ** 30,
+                            help="stage cache disk budget, least recently used entries are evicted")
+    preprocess.add_argument('--storage-policy', choices=list(STORAGE_POLICIES), default='float64',
+                            help="dtype of the exported slices; uint8 stores 255 steps of [0, 1]")
+
+    for subparser in (extract, preprocess):
+        subparser.add_argument('--store-format', choices=['npy', 'ctv'], default='npy')
+        subparser.add_argument('--workers', type=int, default=os.cpu_count())
+        subparser.add_argument('--overwrite', action='store_true', help="rerun patients already done")
+        subparser.add_argument('--skip-failed', action='store_true', help="do not retry failed patients")
+        subparser.add_argument('--verbose', action='store_true', help="show the output of each patient")
+        subparser.add_argument('--log-level', choices=list(LOG_LEVELS), default='info',
+                               help="hide messages below this level")
+        subparser.add_argument('--stage-log', help="append per-stage timing records (JSON lines) to this file, "
+                                                   "summarize with instrumentation.py")
+    args = parser.parse_args(argv)
+
+    set_log_level(args.log_level)
+    set_stage_log(args.stage_log)
+    input_dir = os.path.join(args.input_dir, '')
+    output_dir = os.path.join(args.output_dir, '')
+    if args.step == 'extract' and args.catalog:
+        with DicomCatalog(args.catalog) as catalog:
+            catalog.scan(input_dir)
+            tasks = extract_tasks(catalog.patients(input_dir), input_dir, output_dir, args.prefix, args.subfolder,
+                                  args.store_format, args.io_workers, catalog)
+    elif args.step == 'extract':
+        tasks = extract_tasks(build_patient_list(input_dir, args.subfolder), input_dir, output_dir, args.prefix,
+                              args.subfolder, args.store_format, args.io_workers)
+    else:
+        config = {'apply_lungs_segmentation': args.segment, 'apply_cropping': args.crop,
+                  'store_format': args.store_format, 'cache_dir': args.cache_dir,
+                  'cache_bytes': int(args.cache_gb * 2 ** 30), 'storage_policy': args.storage_policy}
+        tasks = preprocess_tasks(input_dir, output_dir, args.patient_type, config)
+    stats = run_pipeline(tasks, output_dir, workers=args.workers, overwrite=args.overwrite,
+                         retry_failed=not args.skip_failed, verbose=args.verbose)
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
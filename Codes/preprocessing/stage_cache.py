@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from instrumentation import log
+
+# Bump when a stage's implementation changes its output, so old entries are no longer matched
+STAGE_CACHE_VERSION = 1
+STAGE_CACHE_BYTES = 20 * 2 ** 30
+
+
+def array_digest(array):
+    # Content hash of an array: dtype, shape and data
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps([array.dtype.str, array.shape]).encode('utf-8'))
+    digest.update(memoryview(array).cast('B'))
+    return digest.hexdigest()
+
+
+def _param(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (np.generic,)):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_param(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _param(v) for k, v in sorted(value.items())}
+    if isinstance(value, type):
+        return value.__name__
+    return value
+
+
+def stage_key(stage, input_key, **params):
+    # Key of a stage output: the stage name, the key (or digest) of its input artifact and its parameters.
+    # Keys chain: the output key of one stage is the input key of the next, so only the raw input is hashed.
+    payload = json.dumps([STAGE_CACHE_VERSION, stage, input_key, _param(params)], sort_keys=True)
+    return stage + '-' + hashlib.blake2b(payload.encode('utf-8'), digest_size=20).hexdigest()
+
+
+class StageCache:
+    # One .npy file per stage output in cache_dir. Reads bump the file mtime, and writes evict the
+    # least recently used files once the directory exceeds max_bytes. cache_dir=None disables caching
+    # (every lookup is a miss and nothing is stored) so callers need a single code path.
+
+    def __init__(self, cache_dir, max_bytes=STAGE_CACHE_BYTES, mmap=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.mmap = mmap
+        self.stats = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _count(self, stage, name, amount=1):
+        stage_stats = self.stats.setdefault(stage, {'hits': 0, 'misses': 0, 'evictions': 0, 'seconds_computed': 0.})
+        stage_stats[name] += amount
+
+    def get(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            array = np.load(path, mmap_mode='r' if self.mmap else None)
+        except (OSError, ValueError):  # missing, or evicted/being replaced by another worker
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return array
+
+    def put(self, key, array):
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as fh:
+            np.save(fh, array)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def cached(self, stage, key, fn, *args, **kwargs):
+        # Returns fn(*args, **kwargs) from the cache if key is present, computing and storing it otherwise
+        array = self.get(key)
+        if array is not None:
+            self._count(stage, 'hits')
+            return array
+        self._count(stage, 'misses')
+        start = time.perf_counter()
+        array = fn(*args, **kwargs)
+        self._count(stage, 'seconds_computed', time.perf_counter() - start)
+        self.put(key, array)
+        return array
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path, entry.name))
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, path, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self._count(name.split('-', 1)[0], 'evictions')
+        return total
+
+    def summary(self):
+        for stage, stage_stats in sorted(self.stats.items()):
+            lookups = stage_stats['hits'] + stage_stats['misses']
+            log("StageCache|Info ==> {:<12} hits {:5d}  misses {:5d}  hit rate {:5.1f}%  evictions {:4d}  "
+                "computed {:8.1f}s".format(stage, stage_stats['hits'], stage_stats['misses'],
+                                           100. * stage_stats['hits'] / max(1, lookups), stage_stats['evictions'],
+                                           stage_stats['seconds_computed']))
+        return self.stats
+
+
+def merge_stage_stats(total, stats):
+    for stage, stage_stats in stats.items():
+        total_stats = total.setdefault(stage, dict.fromkeys(stage_stats, 0))
+        for name, value in stage_stats.items():
+            total_stats[name] += value
+    return total
@@ -0,0 +1,60 @@
+import numpy as np
+import pydicom
+
+from dcm_utilities import list_dcm_files, load_ct_volume
+from instrumentation import instrumented, log
+from utilities import RESAMPLE_SLAB_HALO, resample_geometry, resample_ct_slab, normalize_hu
+from volume_store import CTV_EXTENSION, VolumeWriter, open_volume
+
+# Output slices resampled per slab, and extra input slices read on each side of a slab so the
+# spline prefilter sees the same neighbourhood as a whole-volume resample
+SLAB_SIZE = 32
+SLAB_HALO = RESAMPLE_SLAB_HALO
+
+
+@instrumented()
+def stream_ct_pixels(path, out_npy, workers=4, dcm_files=None, presorted=False):
+    # Step 1 without an in-memory volume: pixels are decoded straight into a .npy memmap
+    if dcm_files is None:
+        dcm_files = list_dcm_files(path)
+    header = pydicom.dcmread(dcm_files[0], stop_before_pixels=True)
+    shape = (len(dcm_files), int(header.Rows), int(header.Columns))
+    out = np.lib.format.open_memmap(out_npy, mode='w+', dtype=np.int16, shape=shape)
+    _, spacing = load_ct_volume(path, workers=workers, dcm_files=dcm_files, presorted=presorted, out=out)
+    out.flush()
+    log("stream_ct_pixels|Info ==> saved", str(shape), "to:", out_npy)
+    return shape, spacing
+
+
+def iter_ct_slabs(ct_pixels, ct_pixel_spacing, new_spacing=[1, 1, 1], slab_size=SLAB_SIZE, halo=SLAB_HALO,
+                  order=3, separable=True):
+    new_shape, _, _ = resample_geometry(ct_pixels.shape, ct_pixel_spacing, new_spacing)
+    for z_start in range(0, new_shape[0], slab_size):
+        z_stop = min(z_start + slab_size, new_shape[0])
+        yield z_start, z_stop, resample_ct_slab(ct_pixels, new_shape, z_start, z_stop, halo=halo, order=order,
+                                                separable=separable)
+
+
+@instrumented()
+def stream_preprocess_ct(ct_pixels, ct_pixel_spacing, out_npy, new_spacing=[1, 1, 1],
+                         slab_size=SLAB_SIZE, halo=SLAB_HALO):
+    # Step 2 resample -> truncate_hu -> normalize, one z-slab at a time. ct_pixels may be a
+    # memmap (np.load(..., mmap_mode='r') or CTVolume.memmap()), so peak memory is bounded by the
+    # slab size. The output is a .npy memmap, or a compressed volume when out_npy ends in .ctv.
+    new_shape, _, real_spacing = resample_geometry(ct_pixels.shape, ct_pixel_spacing, new_spacing)
+    slabs = iter_ct_slabs(ct_pixels, ct_pixel_spacing, new_spacing, slab_size, halo)
+    if out_npy.endswith(CTV_EXTENSION):
+        with VolumeWriter(out_npy, new_shape, np.float64, real_spacing, compression='zlib') as out:
+            for _, _, slab in slabs:
+                out.write(normalize_hu(slab, np.float64))
+        out = open_volume(out_npy)
+    else:
+        out = np.lib.format.open_memmap(out_npy, mode='w+', dtype=np.float64, shape=new_shape)
+        for z_start, z_stop, slab in slabs:
+            normalize_hu(slab, out=out[z_start:z_stop])
+        out.flush()
+    log("stream_preprocess_ct|Info ==>",
+        "Original shape  :", str(ct_pixels.shape),
+        "New shape  :", str(new_shape))
+    log("stream_preprocess_ct|Info ==> saved normalized volume to:", out_npy)
+    return out
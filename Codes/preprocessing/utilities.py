@@ -1,27 +1,32 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
 import matplotlib.pyplot as plt
 import scipy.misc
 import scipy.ndimage
 
-import skimage
 from skimage.segmentation import clear_border
-from skimage.measure import label, regionprops
-from skimage.morphology import disk, binary_erosion, binary_closing
+from skimage.measure import label
 from skimage.filters import roberts
 from scipy import ndimage as ndi
 
+from instrumentation import instrumented, log
+from volume_store import CTV_EXTENSION, write_volume, encode_normalized, storage_dtype, storage_scale
+
 np.set_printoptions(precision=2)
 
 
 def check_paths_validity(path_lst):
     for path in path_lst:
         if os.path.isdir(path):
-            print(path, " --> OK")
+            log(path, " --> OK")
         else:
-            print(path, " --> Error!")
+            log(path, " --> Error!")
 
 
 def build_patient_list(ct_scans_path,subfolder=''):
@@ -36,10 +41,10 @@ def build_patient_list(ct_scans_path,subfolder=''):
                     dcm_files.append(file)
             if len(dcm_files) > 0:
                 patients.append(folder)
-                print("build_patient_list|Info: patient <{}> found with {} dcm files".format(ct_scans_path + folder, len(dcm_files)))
+                log("build_patient_list|Info: patient <{}> found with {} dcm files".format(ct_scans_path + folder, len(dcm_files)))
             else:
-                print("build_patient_list|Warn: empty patient data folder ", ct_scans_path + folder)
-    print("Patients detected:{}".format(str(len(patients))))
+                log("build_patient_list|Warn: empty patient data folder ", ct_scans_path + folder)
+    log("Patients detected:{}".format(str(len(patients))))
     return sorted(patients)
 
 
@@ -47,14 +52,14 @@ def read_annotation_data(annotation_csv):
     df_annotation = pd.read_csv(annotation_csv).dropna()
     annotation_count = df_annotation.ID.count()
     patient_count = df_annotation['ID'].nunique()
-    print("read_annotation_data|Info: {} annotations for {} patients {}".format(annotation_count, patient_count,
-                                                                                annotation_csv))
+    log("read_annotation_data|Info: {} annotations for {} patients {}".format(annotation_count, patient_count,
+                                                                              annotation_csv))
     return df_annotation
 
 
 def plot_ct_image(scan):
     num_slices = scan.shape[0]
-    print("viz_ct_scan|Info ==> Slices:", num_slices)
+    log("viz_ct_scan|Info ==> Slices:", num_slices)
     cols = 6
     rows = int(num_slices / cols) + 1
 
@@ -69,26 +74,164 @@ def plot_ct_image(scan):
     plt.close('all')
 
 
-def resample_ct_pixels(ct_pixels, ct_pixel_spacing, new_spacing=[1, 1, 1]):
-    resize_factor = ct_pixel_spacing / new_spacing
-    new_real_shape = ct_pixels.shape * resize_factor
+def resample_geometry(shape, ct_pixel_spacing, new_spacing=[1, 1, 1]):
+    resize_factor = ct_pixel_spacing / np.asarray(new_spacing)
+    new_real_shape = shape * resize_factor
     new_shape = np.round(new_real_shape)
-    real_resize_factor = new_shape / ct_pixels.shape
+    real_resize_factor = new_shape / shape
     new_spacing = ct_pixel_spacing / real_resize_factor
+    return tuple(int(n) for n in new_shape), real_resize_factor, new_spacing
+
+
+@instrumented()
+def resample_ct_pixels(ct_pixels, ct_pixel_spacing, new_spacing=[1, 1, 1]):
+    _, real_resize_factor, new_spacing = resample_geometry(ct_pixels.shape, ct_pixel_spacing, new_spacing)
     ct_resampled = scipy.ndimage.interpolation.zoom(ct_pixels, real_resize_factor, mode='nearest')
-    print("resample_ct_pixels|Info ==>",
-          "Original shape  :", str(ct_pixels.shape),
-          "New shape  :", str(ct_resampled.shape))
-    print("resample_ct_pixels|Info ==>",
-          "Original spacing:", ct_pixel_spacing,
-          "New spacing:", new_spacing)
+    log("resample_ct_pixels|Info ==>",
+        "Original shape  :", str(ct_pixels.shape),
+        "New shape  :", str(ct_resampled.shape))
+    log("resample_ct_pixels|Info ==>",
+        "Original spacing:", ct_pixel_spacing,
+        "New spacing:", new_spacing)
     return ct_resampled
 
 
+# Input slices read around a slab for the cubic spline prefilter: the influence of slices further away
+# (0.268 ** 24 relative) is below float64 precision, so slabs give the same int16 output as the whole volume
+RESAMPLE_SLAB_HALO = 24
+# Edge padding scipy.ndimage adds before prefiltering with mode='nearest'
+_SPLINE_PAD = 12
+
+
+def _spline_coefficients(slab, order):
+    # (coefficients, pad) as scipy.ndimage prefilters for mode='nearest'; orders 0 and 1 use the samples
+    if order <= 1:
+        return slab, 0
+    return ndi.spline_filter(np.pad(slab, _SPLINE_PAD, mode='edge'), order, output=np.float64,
+                             mode='nearest'), _SPLINE_PAD
+
+
+def _interpolate_slices(coefficients, pad, scale, z_coords, out, order):
+    # One output slice per call, with its source z coordinate (relative to the slab) as the offset.
+    # The matrix is passed as 2D: a diagonal one would go through zoom_shift, which computes
+    # (o + offset / scale) * scale and can round a coordinate differently from zoom.
+    matrix = np.diag(np.asarray(scale, dtype=np.float64))
+    for i, z in enumerate(z_coords):
+        ndi.affine_transform(coefficients, matrix, offset=[z + pad] + [pad] * (coefficients.ndim - 1),
+                             output_shape=(1,) + out.shape[1:], output=out[i:i + 1], order=order, mode='nearest',
+                             prefilter=False)
+    return out
+
+
+def resample_ct_slab(ct_pixels, new_shape, z_start, z_stop, halo=RESAMPLE_SLAB_HALO, order=3, separable=False,
+                     out=None):
+    # Resample output slices [z_start, z_stop) of the volume resample_ct_pixels would produce.
+    # Only the input slices they map to, plus a halo for the spline prefilter, are read. Source coordinates
+    # are computed for the whole volume as zoom does and only then made relative to the slab, so the
+    # non-separable output equals resample_ct_pixels (scipy's zoom at the same order) bit for bit.
+    in_shape = np.array(ct_pixels.shape)
+    out_shape = np.array(new_shape)
+    scale = (in_shape - 1) / np.maximum(out_shape - 1, 1)
+    z_coords = np.arange(z_start, z_stop) * scale[0]
+    halo = halo if order > 1 else 1
+    slab_start = max(0, int(np.floor(z_coords[0])) - halo)
+    slab_stop = min(int(in_shape[0]), int(np.ceil(z_coords[-1])) + halo + 1)
+    slab = np.asarray(ct_pixels[slab_start:slab_stop])
+    # exact: slab_start is an integer not above the coordinates
+    z_coords -= slab_start
+    slab_shape = (z_stop - z_start,) + tuple(new_shape[1:])
+    if out is None:
+        out = np.empty(slab_shape, dtype=ct_pixels.dtype)
+    if not separable:
+        coefficients, pad = _spline_coefficients(slab, order)
+        return _interpolate_slices(coefficients, pad, scale, z_coords, out, order)
+
+    # Separable path: 2D in-plane interpolation of every input slice, then 1D interpolation along z.
+    # Axes with an identity mapping are evaluated on the spline knots, where the interpolating
+    # spline reproduces its input, so the result equals the 3D tensor-product spline (to float rounding,
+    # within 1 HU of zoom); it does not depend on the slab boundaries.
+    in_plane = np.empty((len(slab),) + tuple(new_shape[1:]), dtype=np.float64)
+    for i in range(len(slab)):
+        scipy.ndimage.affine_transform(slab[i], scale[1:], output_shape=in_plane.shape[1:], output=in_plane[i],
+                                       order=order, mode='nearest')
+    coefficients, pad = _spline_coefficients(in_plane.reshape(len(slab), -1), order)
+    resampled = _interpolate_slices(coefficients, pad, [scale[0], 1], z_coords,
+                                    np.empty((slab_shape[0], in_plane[0].size)), order)
+    if out.dtype.kind in 'iu':
+        np.rint(resampled, out=resampled)
+    np.copyto(out, resampled.reshape(slab_shape), casting='unsafe')
+    return out
+
+
+@instrumented()
+def resample_ct_pixels_parallel(ct_pixels, ct_pixel_spacing, new_spacing=[1, 1, 1], order=3, workers=4,
+                                chunk_size=32, halo=RESAMPLE_SLAB_HALO, separable=False, out=None):
+    # Same geometry and output as resample_ct_pixels; z-chunks (with halos) are resampled on a thread pool,
+    # scipy.ndimage releases the GIL while interpolating. separable=True is faster and within 1 HU.
+    new_shape, _, real_spacing = resample_geometry(ct_pixels.shape, ct_pixel_spacing, new_spacing)
+    if out is None:
+        out = np.empty(new_shape, dtype=ct_pixels.dtype)
+    elif out.shape != new_shape:
+        raise ValueError("output buffer must have shape {}".format(new_shape))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(resample_ct_slab, ct_pixels, new_shape, z_start,
+                                   min(z_start + chunk_size, new_shape[0]), halo, order, separable,
+                                   out[z_start:z_start + chunk_size])
+                   for z_start in range(0, new_shape[0], chunk_size)]
+        for future in futures:
+            future.result()
+    log("resample_ct_pixels_parallel|Info ==>",
+        "Original shape  :", str(ct_pixels.shape),
+        "New shape  :", str(out.shape))
+    log("resample_ct_pixels_parallel|Info ==>",
+        "Original spacing:", ct_pixel_spacing,
+        "New spacing:", real_spacing)
+    return out
+
+
+def model_grid_geometry(shape, ct_pixel_spacing, out_size=128, new_spacing=[1, 1, 1]):
+    # Output shape and the per-axis scale/offset mapping output voxels to input voxels for
+    # resample_ct_pixels(new_spacing) followed by skimage's resize of every slice to out_size x out_size:
+    # zoom aligns the corner voxels, resize the pixel centres.
+    grid_shape, _, _ = resample_geometry(shape, ct_pixel_spacing, new_spacing)
+    out_shape = (grid_shape[0], out_size, out_size)
+    grid = np.asarray(grid_shape, dtype=np.float64)
+    zoom_scale = (np.asarray(shape) - 1) / np.maximum(grid - 1, 1)
+    resize_scale = grid / out_shape
+    return out_shape, zoom_scale * resize_scale, zoom_scale * (resize_scale - 1) / 2
+
+
+@instrumented()
+def resample_to_model_grid(ct_pixels_hu, ct_pixel_spacing, out_size=128, new_spacing=[1, 1, 1], bbox=None, order=3,
+                           anti_aliasing=True):
+    # Inference geometry: one interpolation from the native HU volume straight to the network input grid
+    # (slices of new_spacing, out_size x out_size in-plane), normalized to [0, 1] as float32, instead of
+    # resample_ct_pixels -> normalize_hu -> resize. bbox: (z, y, x) slices of a crop box in native voxels.
+    # HU values are blurred and interpolated as float32 (cubic, as the zoom of resample_ct_pixels) and
+    # normalized last: truncating to [-1000, 400] does not commute with interpolation at bone and air edges.
+    if bbox is not None:
+        ct_pixels_hu = ct_pixels_hu[bbox]
+    out_shape, scale, offset = model_grid_geometry(ct_pixels_hu.shape, ct_pixel_spacing, out_size, new_spacing)
+    ct_hu = ct_pixels_hu.astype(np.float32)
+    if anti_aliasing:
+        # sigma as skimage's resize for the combined down-scaling factor, 0 along upsampled axes
+        sigma = np.maximum(0, (scale - 1) / 2)
+        if sigma.any():
+            ct_hu = ndi.gaussian_filter(ct_hu, sigma, mode='nearest')
+    ct_model_hu = ndi.affine_transform(ct_hu, scale, offset=offset, output_shape=out_shape, order=order,
+                                       mode='nearest')
+    ct_model = normalize_hu(ct_model_hu, np.float32)
+    log("resample_to_model_grid|Info ==>",
+        "Original shape  :", str(ct_pixels_hu.shape),
+        "New shape  :", str(ct_model.shape))
+    return ct_model
+
+
 MIN_BOUND_HU = -1000.0
 MAX_BOUND_HU = 400.0
 
 
+@instrumented()
 def truncate_hu(ct_img_array):
     # set all hu values outside the range [-1000,400] to -1000 (corresponds to air)
     ct_img_array[ct_img_array > MAX_BOUND_HU] = -1000
@@ -96,57 +239,189 @@ def truncate_hu(ct_img_array):
     return ct_img_array
 
 
-def normalize(ct_img_array):
+@instrumented()
+def normalize(ct_img_array, policy=None):
+    # Result in the storage policy's dtype (float64 unless set_storage_policy or policy says otherwise)
     ct_img_array = (ct_img_array - MIN_BOUND_HU) / (MAX_BOUND_HU - MIN_BOUND_HU)
     ct_img_array[ct_img_array > 1] = 1.
     ct_img_array[ct_img_array < 0] = 0.
-    return ct_img_array
-
-
-def compute_lung_mask(ct_img_array, threshold=-350):
+    return encode_normalized(ct_img_array, policy)
+
+
+_NORMALIZE_LUTS = {}
+# Voxels per normalize_hu lookup slab: 16 MB of intp indices
+NORMALIZE_SLAB_VOXELS = 2 ** 21
+
+
+def _normalize_lut(dtype):
+    # truncate_hu + normalize evaluated once for every int16 value, indexed by its uint16 bit pattern
+    dtype = np.dtype(dtype)
+    if dtype not in _NORMALIZE_LUTS:
+        hu = np.arange(2 ** 16, dtype=np.uint32).astype(np.uint16).view(np.int16)
+        lut = normalize(truncate_hu(hu.copy()), 'float64')
+        if dtype == np.uint8:
+            lut = np.rint(lut * 255)
+        _NORMALIZE_LUTS[dtype] = lut.astype(dtype)
+    return _NORMALIZE_LUTS[dtype]
+
+
+@instrumented()
+def normalize_hu(ct_img_array, dtype=np.float32, out=None):
+    # Fused truncate_hu -> normalize: one pass over the volume and the input is left untouched. uint8 output is
+    # quantized to 255 steps of the [0, 1] range; dtype may also be a storage policy name.
+    if out is None:
+        out = np.empty(ct_img_array.shape, dtype=dtype)
+    dtype = out.dtype
+    if ct_img_array.dtype == np.int16:
+        # np.take casts the indices to intp (8 bytes per voxel), so the lookup runs over z-slabs of at most
+        # NORMALIZE_SLAB_VOXELS; mode='clip' (every uint16 is a valid index) writes straight into out
+        lut = _normalize_lut(dtype)
+        if ct_img_array.ndim == 0:
+            out[()] = lut[ct_img_array.view(np.uint16)]
+            return out
+        depth = max(1, NORMALIZE_SLAB_VOXELS // max(1, int(np.prod(ct_img_array.shape[1:]))))
+        for z in range(0, ct_img_array.shape[0], depth):
+            np.take(lut, ct_img_array[z:z + depth].view(np.uint16), out=out[z:z + depth], mode='clip')
+        return out
+
+    work = out if dtype in (np.float32, np.float64) else np.empty(ct_img_array.shape, dtype=np.float32)
+    np.subtract(ct_img_array, MIN_BOUND_HU, out=work, casting='unsafe')
+    np.divide(work, MAX_BOUND_HU - MIN_BOUND_HU, out=work)
+    work[(ct_img_array > MAX_BOUND_HU) | (ct_img_array < MIN_BOUND_HU)] = 0.
+    if dtype == np.uint8:
+        np.rint(work * 255, out=work)
+    if work is not out:
+        np.copyto(out, work, casting='unsafe')
+    return out
+
+
+def keep_largest_labels(label_image, count=2):
+    # Keep the labels with the `count` largest areas (ties with the smallest kept area survive too)
+    areas = np.bincount(label_image.ravel())
+    areas[0] = 0
+    if len(areas) - 1 > count:
+        min_area = np.partition(areas[1:], -count)[-count]
+        keep = areas >= min_area
+    else:
+        keep = areas > 0
+    keep[0] = False
+    return keep[label_image]
+
+
+def binary_closing_disk(binary_mask, radius):
+    # Same result as binary_closing(binary_mask, disk(radius)) for integer radii, computed as two Euclidean
+    # distance thresholds on the bounding box of the mask, so the cost does not grow with the radius
+    closed = np.zeros(binary_mask.shape, dtype=bool)
+    rows = np.flatnonzero(binary_mask.any(axis=1))
+    if len(rows) == 0:
+        return closed
+    cols = np.flatnonzero(binary_mask.any(axis=0))
+    margin = int(np.ceil(radius)) + 1
+    box = (slice(max(rows[0] - margin, 0), rows[-1] + margin + 1),
+           slice(max(cols[0] - margin, 0), cols[-1] + margin + 1))
+    dilated = ndi.distance_transform_edt(~binary_mask[box]) <= radius
+    closed[box] = ndi.distance_transform_edt(dilated) > radius if not dilated.all() else True
+    return closed
+
+
+def _close_and_fill_lung_slice(binary_mask, radius=10):
+    '''
+    Step 5: Closure operation with a disk of radius 10. This operation is 
+    to keep nodules attached to the lung wall.
+    '''
+    binary_mask = binary_closing_disk(binary_mask, radius)
+    '''
+    Step 5: Fill in the small holes inside the binary mask of lungs.
+    '''
+    edges = roberts(binary_mask)
+    return ndi.binary_fill_holes(edges)
+
+
+def _lung_mask_slice(img, threshold, radius=10):
+    '''
+    Step 1: Convert into a binary image. 
+    '''
+    binary_mask = img < threshold
+    '''
+    Step 2: Remove the blobs connected to the border of the image.
+    '''
+    cleared = clear_border(binary_mask)
+    '''
+    Step 3: Label the image.
+    '''
+    label_image = label(cleared)
+    '''
+    Step 4: Keep the labels with 2 largest areas.
+    '''
+    binary_mask = keep_largest_labels(label_image, 2)
+    return _close_and_fill_lung_slice(binary_mask, radius)
+
+
+def _downsample_mean(img, factor):
+    # Means over factor x factor pixel blocks, edge blocks padded by replication
+    pad = [(0, -n % factor) for n in img.shape]
+    coarse_shape = [-(-n // factor) for n in img.shape]
+    return np.pad(img.astype(np.float32), pad, mode='edge').reshape(
+        coarse_shape[0], factor, coarse_shape[1], factor).mean(axis=(1, 3))
+
+
+def _coarse_lung_mask_slice(img, threshold, radius=10, factor=2):
+    # Lung mask of a slice downsampled by `factor`, upsampled back: pixels deeper than `factor`
+    # inside the coarse mask are kept as is, pixels within `factor` of its boundary are re-thresholded
+    # at full resolution and the holes are filled again
+    coarse_mask = _lung_mask_slice(_downsample_mean(img, factor), threshold, radius / factor)
+    mask = np.repeat(np.repeat(coarse_mask, factor, axis=0), factor, axis=1)[:img.shape[0], :img.shape[1]]
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return mask
+    cols = np.flatnonzero(mask.any(axis=0))
+    box = (slice(max(rows[0] - factor, 0), rows[-1] + factor + 1),
+           slice(max(cols[0] - factor, 0), cols[-1] + factor + 1))
+    box_mask = mask[box].view(np.uint8)
+    inner = ndi.minimum_filter(box_mask, size=2 * factor + 1) > 0
+    outer = ndi.maximum_filter(box_mask, size=2 * factor + 1) > 0
+    mask[box] = ndi.binary_fill_holes(inner | (outer & (img[box] < threshold)))
+    return mask
+
+
+def _map_slices(fn, slices, workers, use_processes):
+    if workers <= 1:
+        return map(fn, slices)
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        return list(executor.map(fn, slices, chunksize=max(1, len(slices) // (4 * workers))))
+
+
+@instrumented()
+def compute_lung_mask(ct_img_array, threshold=-350, workers=1, use_processes=False, mode='2d', closing_radius=10,
+                      coarse_factor=2):
+    # mode='2d' keeps the two largest regions of every slice, mode='3d' the two largest
+    # 3D connected components of the whole volume before the per-slice closing.
+    # mode='coarse' runs the 2d pipeline on slices downsampled by coarse_factor in-plane and only
+    # re-thresholds a band of coarse_factor pixels around the upsampled boundary at full resolution.
     num_slices = ct_img_array.shape[0]
-    lung_mask = []
-    for i in range(num_slices):
-        img = ct_img_array[i]
-        '''
-        Step 1: Convert into a binary image. 
-        '''
-        binary_mask = img < threshold
-        '''
-        Step 2: Remove the blobs connected to the border of the image.
-        '''
-        cleared = clear_border(binary_mask)
-        '''
-        Step 3: Label the image.
-        '''
-        label_image = label(cleared)
-        '''
-        Step 4: Keep the labels with 2 largest areas.
-        '''
-        areas = [r.area for r in regionprops(label_image)]
-        areas.sort()
-        if len(areas) > 2:
-            for region in regionprops(label_image):
-                if region.area < areas[-2]:
-                    for coordinates in region.coords:
-                        label_image[coordinates[0], coordinates[1]] = 0
-        binary_mask = label_image > 0
-        '''
-        Step 5: Closure operation with a disk of radius 10. This operation is 
-        to keep nodules attached to the lung wall.
-        '''
-        selem = disk(10)
-        binary_mask = binary_closing(binary_mask, selem)
-        '''
-        Step 5: Fill in the small holes inside the binary mask of lungs.
-        '''
-        edges = roberts(binary_mask)
-        binary_mask = ndi.binary_fill_holes(edges)
-        lung_mask.append(binary_mask)
-
-    return np.asarray(lung_mask)
+    lung_mask = np.empty(ct_img_array.shape, dtype=bool)
+    if mode == '3d':
+        cleared = np.empty(ct_img_array.shape, dtype=bool)
+        for i in range(num_slices):
+            cleared[i] = clear_border(ct_img_array[i] < threshold)
+        binary_mask = keep_largest_labels(label(cleared), 2)
+        slice_masks = _map_slices(partial(_close_and_fill_lung_slice, radius=closing_radius), list(binary_mask),
+                                  workers, use_processes)
+    elif mode == '2d':
+        slice_masks = _map_slices(partial(_lung_mask_slice, threshold=threshold, radius=closing_radius),
+                                  list(ct_img_array), workers, use_processes)
+    elif mode == 'coarse':
+        slice_masks = _map_slices(partial(_coarse_lung_mask_slice, threshold=threshold, radius=closing_radius,
+                                          factor=coarse_factor), list(ct_img_array), workers, use_processes)
+    else:
+        raise ValueError("unknown lung mask mode {!r}, expected '2d', '3d' or 'coarse'".format(mode))
+    for i, slice_mask in enumerate(slice_masks):
+        lung_mask[i] = slice_mask
+    return lung_mask
 
 
+@instrumented()
 def apply_lung_mask(ct_img_array, lung_mask):
     ct_lung_seg = ct_img_array.copy()
     ct_lung_seg[lung_mask == 0] = 0
@@ -155,7 +430,7 @@ def apply_lung_mask(ct_img_array, lung_mask):
 
 def viz_ct_scan(scan, out_pdf_file):
     num_slices = scan.shape[0]
-    print("viz_ct_scan|Info ==> Slices:", num_slices)
+    log("viz_ct_scan|Info ==> Slices:", num_slices)
     cols = 6
     rows = int(num_slices / cols) + 1
 
@@ -181,38 +456,83 @@ def last_nonzero(arr, axis, invalid_val=-1):
     return np.where(mask.any(axis=axis), val, invalid_val)
 
 
-def crop_ct_lungs(scan, mask, margin=32):
-    num_slices = mask.shape[0]
-    h_min = mask.shape[1]
-    h_max = 0
-    v_min = mask.shape[2]
-    v_max = 0
-
-    crop_slices = []
+def lung_bbox(mask, margin=32):
+    # (z, y, x) slices of the mask bounding box grown by `margin` in-plane, from axis projections of the
+    # mask instead of a per-slice scan. Like the per-slice scan, an empty slice counts as a mask ending
+    # at `margin` and starting at `margin` before the far border, and the lower bounds start from the
+    # opposite axis size.
+    num_slices, height, width = mask.shape
+    rows_by_slice = mask.any(axis=2)
+    nonempty = rows_by_slice.any(axis=1)
+    rows = np.flatnonzero(rows_by_slice.any(axis=0))
+    h_min, h_max, v_min, v_max = height, 0, width, 0
+    if len(rows):
+        cols = np.flatnonzero(mask[:, rows[0]:rows[-1] + 1].any(axis=(0, 1)))
+        h_min, h_max = min(h_min, max(0, cols[0] - margin)), max(h_max, min(width, cols[-1] + margin))
+        v_min, v_max = min(v_min, max(0, rows[0] - margin)), max(v_max, min(height, rows[-1] + margin))
+    if num_slices and not nonempty.all():
+        h_min, h_max = min(h_min, max(0, width - margin)), max(h_max, min(width, margin))
+        v_min, v_max = min(v_min, max(0, height - margin)), max(v_max, min(height, margin))
+    return slice(None), slice(int(v_min), int(v_max)), slice(int(h_min), int(h_max))
+
+
+@instrumented()
+def crop_ct_lungs(scan, mask=None, margin=32, copy=False, bbox=None, policy=None):
+    # Returns a view of scan unless copy=True or a policy with another dtype is given;
+    # pass bbox (from lung_bbox) to crop other arrays the same way
+    if bbox is None:
+        bbox = lung_bbox(mask, margin)
+    scan_crop = scan[bbox]
+    if policy is not None and scan_crop.dtype != storage_dtype(policy):
+        scan_crop = encode_normalized(scan_crop, policy)
+    elif copy:
+        scan_crop = scan_crop.copy()
+    log("lung_seg_crop|Info ==> original shape {} --> cropped shape {}".format(scan.shape, scan_crop.shape))
+    return scan_crop
 
-    for i in range(num_slices):
-        img = mask[i, :, :]
-        img_x_min = max(0, np.min(first_nonzero(img, axis=1, invalid_val=img.shape[1])) - margin)
-        img_x_max = min(img.shape[1], np.max(last_nonzero(img, axis=1, invalid_val=0)) + margin)
-        img_y_min = max(0, np.min(first_nonzero(img, axis=0, invalid_val=img.shape[0])) - margin)
-        img_y_max = min(img.shape[0], np.max(last_nonzero(img, axis=0, invalid_val=0)) + margin)
-        if img_x_min < h_min:
-            h_min = img_x_min
-        if img_x_max > h_max:
-            h_max = img_x_max
-        if img_y_min < v_min:
-            v_min = img_y_min
-        if img_y_max > v_max:
-            v_max = img_y_max
 
-    for i in range(num_slices):
-        crop_slices.append(scan[i, v_min:v_max, h_min:h_max])
-    scan_crop = np.asarray(crop_slices)
-    print("lung_seg_crop|Info ==> original shape {} --> cropped shape {}".format(scan.shape, scan_crop.shape))
-    return scan_crop
+def normal_patch_windows(lung_seg_cropped, patch_shape, stride):
+    # Read-only strided view (n_d, n_h, n_w, dd, hh, ww) of every patch export_normal_patches writes,
+    # same window origins as range(0, depth - dd, stride_d) etc.
+    if any(n <= p for n, p in zip(lung_seg_cropped.shape, patch_shape)):
+        return np.empty((0, 0, 0) + tuple(patch_shape), dtype=lung_seg_cropped.dtype)
+    windows = sliding_window_view(lung_seg_cropped, tuple(patch_shape))
+    return windows[tuple(slice(0, max(0, n - p), s) for n, p, s in zip(lung_seg_cropped.shape, patch_shape, stride))]
+
+
+@instrumented()
+def export_normal_patches(lung_seg_cropped, patch_shape, stride, out_path, patch_npy_prefix, patient_id,
+                          dtype=None, mode='strided'):
+    # mode='strided' copies one row of windows at a time from a strided view into a .npy memmap of the
+    # final shape; mode='list' is the original list-of-copies implementation. dtype is a storage policy
+    # (None: the pipeline-wide one).
+    dtype = storage_dtype(dtype)
+    if mode == 'list':
+        return _export_normal_patches_list(lung_seg_cropped, patch_shape, stride, out_path, patch_npy_prefix,
+                                           patient_id, dtype)
+    dd, hh, ww = patch_shape
+    windows = normal_patch_windows(lung_seg_cropped, patch_shape, stride)
+    num_patches = windows.shape[0] * windows.shape[1] * windows.shape[2]
+    if num_patches > 0:
+        out_normal_patch_npy = out_path + patch_npy_prefix + "_" + str(num_patches).zfill(4) + "_" + \
+                               str(dd).zfill(3) + "_" + str(hh).zfill(3) + "_" + str(ww).zfill(3) + "_" + \
+                               patient_id + ".npy"
+        patch = np.lib.format.open_memmap(out_normal_patch_npy, mode='w+', dtype=dtype,
+                                          shape=(num_patches, dd, hh, ww))
+        i = 0
+        for window_plane in windows:
+            for window_row in window_plane:
+                encode_normalized(window_row, dtype, out=patch[i:i + len(window_row)])
+                i += len(window_row)
+        patch.flush()
+        del patch
+        log("export_normal_patches|Info: saved patch:", out_normal_patch_npy)
+    else:
+        log('export_normal_patches|Error: no data to export as patch')
 
 
-def export_normal_patches(lung_seg_cropped, patch_shape, stride, out_path, patch_npy_prefix, patient_id):
+def _export_normal_patches_list(lung_seg_cropped, patch_shape, stride, out_path, patch_npy_prefix, patient_id,
+                                dtype=np.float64):
     patches = []
     depth = lung_seg_cropped.shape[0]
     height = lung_seg_cropped.shape[1]
@@ -235,17 +555,20 @@ def export_normal_patches(lung_seg_cropped, patch_shape, stride, out_path, patch
                 if (d1 <= depth) and (h1 <= height) and (w1 <= width):
                     patches.append(lung_seg_cropped[d:d1, h:h1, w:w1])
     if len(patches) > 0:
-        patch = np.asarray(patches)
-        assert patch.dtype == 'float64'
+        patch = encode_normalized(np.asarray(patches), dtype)
         out_normal_patch_npy = out_path + patch_npy_prefix + "_" + str(len(patches)).zfill(4) + "_" + \
                                str(dd).zfill(3) + "_" + str(hh).zfill(3) + "_" + str(ww).zfill(3) + "_" + \
                                patient_id + ".npy"
         np.save(out_normal_patch_npy, patch)
-        print("export_normal_patches|Info: saved patch:", out_normal_patch_npy)
+        log("export_normal_patches|Info: saved patch:", out_normal_patch_npy)
     else:
-        print('export_normal_patches|Error: no data to export as patch')
+        log('export_normal_patches|Error: no data to export as patch')
 
-def export_normal_slices(lung_seg_cropped, patch_shape, stride, out_path, patch_npy_prefix, patient_id):
+@instrumented()
+def export_normal_slices(lung_seg_cropped, patch_shape, stride, out_path, patch_npy_prefix, patient_id,
+                         store_format='npy', spacing=(1, 1, 1), policy=None):
+    lung_seg_cropped = encode_normalized(lung_seg_cropped, policy)
+    scale = storage_scale(lung_seg_cropped.dtype)
     depth = lung_seg_cropped.shape[0]
     height = lung_seg_cropped.shape[1]
     width = lung_seg_cropped.shape[2]
@@ -254,98 +577,117 @@ def export_normal_slices(lung_seg_cropped, patch_shape, stride, out_path, patch_
         out_normal_patch_npy = out_path + patch_npy_prefix  + "_" + \
                                str(depth).zfill(3) + "_" + str(height).zfill(3) + "_" + str(width).zfill(3) + "_" + \
                                patient_id + ".npy"
-        np.save(out_normal_patch_npy, lung_seg_cropped)
-        print("export_normal_patches|Info: saved patch:", out_normal_patch_npy)
+        if store_format == 'ctv':
+            out_normal_patch_npy = out_normal_patch_npy[:-len(".npy")] + CTV_EXTENSION
+            write_volume(out_normal_patch_npy, lung_seg_cropped, spacing, label=patch_npy_prefix.split("_")[0],
+                         compression='zlib', attrs={'patient_id': patient_id, 'scale': scale})
+        else:
+            np.save(out_normal_patch_npy, lung_seg_cropped)
+        log("export_normal_patches|Info: saved patch:", out_normal_patch_npy)
     else:
-        print('export_normal_patches|Error: no data to export as patch')
-
-
+        log('export_normal_patches|Error: no data to export as patch')
+
+
+
+
+def annotation_centers(df_patient_annot, patient_ct_spacing, patient_ct_orig_shape,
+                       columns=("Center_z (px)", "Center_y (px)", "Center_x (px)")):
+    # (n, 3) voxel centers in the resampled volume: z is flipped against the original depth, then scaled by spacing
+    depth = int(patient_ct_orig_shape[0])
+    # df_patient_annot: the patient's rows as a DataFrame or AnnotationStore.patient() dict
+    centers = np.column_stack([np.asarray(df_patient_annot[column], dtype=np.float64) for column in columns])
+    centers[:, 0] = depth - centers[:, 0]
+    return np.rint(centers * np.asarray(patient_ct_spacing, dtype=np.float64)).astype(np.int64)
+
+
+def random_annotation_centers(df_patient_annot, patient_ct_spacing, patient_ct_orig_shape, per_annotation=20,
+                              rng=None):
+    # per_annotation random (y, x) centers inside each annotated box, on the box's first slice
+    rng = rng if isinstance(rng, np.random.Generator) else np.random.default_rng(rng)
+    depth = int(patient_ct_orig_shape[0])
+    box = np.column_stack([np.asarray(df_patient_annot[column], dtype=np.int64) for column in
+                           ("Center_z (px)_1", "Center_y (px)_1", "Center_x (px)_1", "Center_y (px)_2", "Center_x (px)_2")])
+    size = (len(box), per_annotation)
+    centers = np.empty(size + (3,), dtype=np.float64)
+    centers[..., 0] = (depth - box[:, 0])[:, None]
+    centers[..., 1] = rng.integers(box[:, 1, None], np.maximum(box[:, 3], box[:, 1] + 1)[:, None], size=size)
+    centers[..., 2] = rng.integers(box[:, 2, None], np.maximum(box[:, 4], box[:, 2] + 1)[:, None], size=size)
+    return np.rint(centers.reshape(-1, 3) * np.asarray(patient_ct_spacing, dtype=np.float64)).astype(np.int64)
+
+
+def gather_centered_patches(lung_seg, centers, output_shape, pad_mode='edge', cval=0, dtype=None,
+                            batch_size=64, out=None):
+    # Patches of output_shape around each (z, y, x) center, gathered batch_size at a time. Patches inside the
+    # volume are read through a strided window view; voxels outside the volume repeat the nearest edge voxel
+    # (pad_mode='edge') or are set to cval (pad_mode='constant'). Quantized output dtypes are encoded
+    # with their storage scale.
+    if pad_mode not in ('edge', 'constant'):
+        raise ValueError("unknown pad_mode {!r}, expected 'edge' or 'constant'".format(pad_mode))
+    centers = np.asarray(centers, dtype=np.int64).reshape(-1, 3)
+    output_shape = tuple(int(n) for n in output_shape)
+    if out is None:
+        out = np.empty((len(centers),) + output_shape, dtype=storage_dtype(dtype))
+    quantized = storage_scale(out.dtype) is not None
+    origins = centers - np.asarray(output_shape) // 2
+    fits = np.all((origins >= 0) & (origins + output_shape <= np.asarray(lung_seg.shape)), axis=1)
+    if fits.any():
+        windows = sliding_window_view(lung_seg, output_shape)
+        for start in range(0, len(centers), batch_size):
+            batch = np.flatnonzero(fits[start:start + batch_size]) + start
+            patches = windows[origins[batch, 0], origins[batch, 1], origins[batch, 2]]
+            out[batch] = encode_normalized(patches, out.dtype) if quantized else patches
+    outside = np.flatnonzero(~fits)
+    for start in range(0, len(outside), batch_size):
+        batch = outside[start:start + batch_size]
+        index = [origins[batch, axis, None] + np.arange(output_shape[axis]) for axis in range(3)]
+        inside = [(i >= 0) & (i < n) for i, n in zip(index, lung_seg.shape)]
+        index = [np.clip(i, 0, n - 1) for i, n in zip(index, lung_seg.shape)]
+        patches = lung_seg[index[0][:, :, None, None], index[1][:, None, :, None], index[2][:, None, None, :]]
+        if pad_mode == 'constant':
+            patches[~(inside[0][:, :, None, None] & inside[1][:, None, :, None] & inside[2][:, None, None, :])] = cval
+        out[batch] = encode_normalized(patches, out.dtype) if quantized else patches
+    return out
+
+
+def _save_centered_patches(lung_seg, centers, output_shape, out_path, patch_npy_prefix, patient_id, pad_mode,
+                           dtype, caller):
+    log("Total centered patches extracted:", len(centers))
+    if len(centers) > 0:
+        out_center_patch_npy = out_path + patch_npy_prefix + "_" +str(len(centers)).zfill(4) + "_" + \
+                               str(output_shape[0]) + "_" + \
+                               str(output_shape[1]) + "_" + \
+                               str(output_shape[2]) + "_" + patient_id + ".npy"
+        output_patch = np.lib.format.open_memmap(out_center_patch_npy, mode='w+', dtype=storage_dtype(dtype),
+                                                 shape=(len(centers),) + tuple(output_shape))
+        gather_centered_patches(lung_seg, centers, output_shape, pad_mode=pad_mode, out=output_patch)
+        output_patch.flush()
+        del output_patch
+        log(caller + "|Info: saved patch:", out_center_patch_npy)
+    else:
+        log(caller + '|Error: no data to export as patch')
 
 
+@instrumented()
 def export_centered_patches(lung_seg,
                             patient_ct_spacing, patient_ct_orig_shape,
                             df_patient_annot, output_shape,
                             out_path,
-                            patch_npy_prefix, patient_id):
-    depth, height, width = patient_ct_orig_shape
-    patch_count = 0
-    centered_patches = []
-
-    for node_idx, cur_row in df_patient_annot.iterrows():
-        node_x = cur_row["Center_x (px)"]
-        node_y = cur_row["Center_y (px)"]
-        node_z = cur_row["Center_z (px)"]
-        out_array = np.zeros((output_shape[0], output_shape[1], output_shape[2]))
-        center = np.array([int(depth) - node_z, node_y, node_x])
-        v_center = np.rint(center * patient_ct_spacing)
-        try:
-            out_array[:, :, :] = lung_seg[[int(v_center[0] - 1), int(v_center[0]), int(v_center[0] + 1)],
-                                 int(v_center[1] - output_shape[1] / 2):int(v_center[1] + output_shape[1] / 2),
-                                 int(v_center[2] - output_shape[2] / 2):int(v_center[2] + output_shape[2] / 2)]
-            centered_patches.append(out_array)
-            patch_count += 1
-        except:
-            # print(node_x,node_y,node_z,"<- The coordinates are out of range!")
-            continue
-
-    print("Total centered patches extracted:", patch_count)
-    if len(centered_patches) > 0:
-        output_patch = np.asarray(centered_patches)
-        out_center_patch_npy = out_path + patch_npy_prefix + "_" +str(len(centered_patches)).zfill(4) + "_" + \
-                               str(output_shape[0]) + "_" + \
-                               str(output_shape[1]) + "_" + \
-                               str(output_shape[2]) + "_" + patient_id + ".npy"
-
-        assert output_patch.dtype == 'float64'
-        np.save(out_center_patch_npy, output_patch)
-        print("export_center_patches|Info: saved patch:", out_center_patch_npy)
-    else:
-        print('export_center_patches|Error: no data to export as patch')
+                            patch_npy_prefix, patient_id, pad_mode='edge', dtype=None):
+    # One patch per annotation; patches reaching outside the volume are padded instead of dropped
+    centers = annotation_centers(df_patient_annot, patient_ct_spacing, patient_ct_orig_shape)
+    _save_centered_patches(lung_seg, centers, output_shape, out_path, patch_npy_prefix, patient_id, pad_mode,
+                           dtype, "export_center_patches")
 
 
+@instrumented()
 def export_random_centered_patches(lung_seg,
                             patient_ct_spacing, patient_ct_orig_shape,
                             df_patient_annot, output_shape,
                             out_path,
-                            patch_npy_prefix, patient_id):
-    depth, height, width = patient_ct_orig_shape
-    patch_count = 0
-    centered_patches = []
-
-    for node_idx, cur_row in df_patient_annot.iterrows():
-        node_x1 = cur_row["Center_x (px)_1"]
-        node_y1 = cur_row["Center_y (px)_1"]
-        node_z1 = cur_row["Center_z (px)_1"]
-        node_x2 = cur_row["Center_x (px)_2"]
-        node_y2 = cur_row["Center_y (px)_2"]
-        out_array = np.zeros((output_shape[0], output_shape[1], output_shape[2]))
-        for i in range(20): # 20 random patches for each slice!
-            node_x = np.random.randint(node_x1,node_x2)
-            node_y = np.random.randint(node_y1,node_y2)
-            center = np.array([int(depth) - node_z1, node_y, node_x])
-            v_center = np.rint(center * patient_ct_spacing)
-            try:
-                out_array[:, :, :] = lung_seg[[int(v_center[0] - 1), int(v_center[0]), int(v_center[0] + 1)],
-                                     int(v_center[1] - output_shape[1] / 2):int(v_center[1] + output_shape[1] / 2),
-                                     int(v_center[2] - output_shape[2] / 2):int(v_center[2] + output_shape[2] / 2)]
-                centered_patches.append(out_array)
-                patch_count += 1
-            except:
-                # print(node_x,node_y,node_z,"<- The coordinates are out of range!")
-                continue
-
-    print("Total centered patches extracted:", patch_count)
-    if len(centered_patches) > 0:
-        output_patch = np.asarray(centered_patches)
-        out_center_patch_npy = out_path + patch_npy_prefix + "_" +str(len(centered_patches)).zfill(4) + "_" + \
-                               str(output_shape[0]) + "_" + \
-                               str(output_shape[1]) + "_" + \
-                               str(output_shape[2]) + "_" + patient_id + ".npy"
-
-        assert output_patch.dtype == 'float64'
-        np.save(out_center_patch_npy, output_patch)
-        print("export_random_centered_patches|Info: saved patch:", out_center_patch_npy)
-    else:
-        print('export_random_centered_patches|Error: no data to export as patch')
-
-
+                            patch_npy_prefix, patient_id, per_annotation=20, seed=None, pad_mode='edge',
+                            dtype=None):
+    # per_annotation patches at random centers inside each annotated box, reproducible for a given seed
+    centers = random_annotation_centers(df_patient_annot, patient_ct_spacing, patient_ct_orig_shape,
+                                        per_annotation, np.random.default_rng(seed))
+    _save_centered_patches(lung_seg, centers, output_shape, out_path, patch_npy_prefix, patient_id, pad_mode,
+                           dtype, "export_random_centered_patches")
@@ -0,0 +1,305 @@
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from instrumentation import instrumented, log
+
+# Single-file volume container (.ctv):
+#   [0:64)   preamble: magic, header offset, header length (little endian uint64)
+#   [64:...) voxel data, either one contiguous C-order array (memmap-able) or zlib-compressed z-chunks
+#   [...]    JSON header: shape, dtype, spacing, label, chunking and any extra attributes
+CTV_MAGIC = b'CTVOL01\n'
+CTV_DATA_OFFSET = 64
+CTV_EXTENSION = '.ctv'
+CTV_CHUNK_DEPTH = 16
+CTV_COMPRESSIONS = (None, 'zlib')
+
+# Storage policies for normalized [0, 1] intensities: name -> (dtype, scale). Quantized policies store
+# rint(value * scale); the scale is written to the .ctv header, .npy files use the scale of their dtype.
+STORAGE_POLICIES = {'float64': (np.float64, None),
+                    'float32': (np.float32, None),
+                    'float16': (np.float16, None),
+                    'uint8': (np.uint8, 255.)}
+DEFAULT_STORAGE_POLICY = 'float64'
+_storage_policy = DEFAULT_STORAGE_POLICY
+
+
+def storage_policy(policy=None):
+    # Policy name for a name or dtype; None is the pipeline-wide policy set with set_storage_policy
+    if policy is None:
+        return _storage_policy
+    name = policy if isinstance(policy, str) else np.dtype(policy).name
+    if name not in STORAGE_POLICIES:
+        raise ValueError("unknown storage policy {!r}, expected one of {}".format(policy, list(STORAGE_POLICIES)))
+    return name
+
+
+def set_storage_policy(policy):
+    # Only affects this process: pass the policy explicitly to work that runs in worker processes
+    global _storage_policy
+    _storage_policy = storage_policy(policy)
+
+
+def storage_dtype(policy=None):
+    return np.dtype(STORAGE_POLICIES[storage_policy(policy)][0])
+
+
+def storage_scale(dtype):
+    # Quantization scale of a stored dtype, None for float dtypes
+    name = np.dtype(dtype).name
+    return STORAGE_POLICIES[name][1] if name in STORAGE_POLICIES else None
+
+
+def encode_normalized(values, policy=None, out=None):
+    # [0, 1] intensities -> storage dtype of the policy; quantized input is decoded first
+    dtype, scale = STORAGE_POLICIES[storage_policy(policy)]
+    values = np.asarray(values)
+    if storage_scale(values.dtype) is not None and values.dtype != dtype:
+        values = decode_normalized(values, dtype=np.float32)
+    if scale is not None and values.dtype.kind == 'f':
+        values = np.rint(np.clip(values, 0., 1.) * scale)
+    if out is None:
+        return values.astype(dtype, copy=False)
+    np.copyto(out, values, casting='unsafe')
+    return out
+
+
+def decode_normalized(values, scale=None, dtype=np.float32):
+    # Stored intensities -> [0, 1] floats; float input is only cast (dtype=None keeps it as is)
+    values = np.asarray(values)
+    scale = scale or storage_scale(values.dtype)
+    if values.dtype.kind == 'f' or scale is None:
+        return values if dtype is None else values.astype(dtype, copy=False)
+    decoded = values.astype(dtype or np.float32)
+    decoded /= scale
+    return decoded
+
+
+class VolumeWriter:
+
+    def __init__(self, path, shape, dtype, spacing, label=None, chunk_depth=CTV_CHUNK_DEPTH,
+                 compression=None, level=1, attrs=None):
+        if compression not in CTV_COMPRESSIONS:
+            raise ValueError("unknown compression {!r}, expected one of {}".format(compression, CTV_COMPRESSIONS))
+        self.path = path
+        self.header = {'version': 1,
+                       'shape': [int(n) for n in shape],
+                       'dtype': np.dtype(dtype).str,
+                       'spacing': [float(s) for s in spacing],
+                       'label': label,
+                       'chunk_depth': int(chunk_depth),
+                       'compression': compression,
+                       'chunks': [],
+                       'attrs': attrs or {}}
+        self.level = level
+        self.z = 0
+        self._pending = []
+        # Written under a temporary name and renamed on close, so a killed run never leaves a valid-looking file
+        self._tmp_path = path + '.tmp'
+        self._fh = open(self._tmp_path, 'wb')
+        self._fh.write(b'\0' * CTV_DATA_OFFSET)
+
+    def write(self, slab):
+        slab = np.ascontiguousarray(slab, dtype=self.header['dtype'])
+        if slab.ndim == 2:
+            slab = slab[None]
+        if list(slab.shape[1:]) != self.header['shape'][1:] or self.z + len(slab) > self.header['shape'][0]:
+            raise ValueError("slab of shape {} does not fit volume {} at z={}".format(
+                slab.shape, self.header['shape'], self.z))
+        self.z += len(slab)
+        if self.header['compression'] is None:
+            self._fh.write(slab.tobytes())
+            return
+        self._pending.append(slab)
+        pending = sum(len(s) for s in self._pending)
+        chunk_depth = self.header['chunk_depth']
+        while pending >= chunk_depth or (pending and self.z == self.header['shape'][0]):
+            buffer = np.concatenate(self._pending) if len(self._pending) > 1 else self._pending[0]
+            chunk, rest = buffer[:chunk_depth], buffer[chunk_depth:]
+            self._pending = [rest] if len(rest) else []
+            pending = len(rest)
+            data = zlib.compress(chunk.tobytes(), self.level)
+            self.header['chunks'].append([self._fh.tell() - CTV_DATA_OFFSET, len(data)])
+            self._fh.write(data)
+
+    def close(self):
+        if self._fh is None:
+            return
+        if self.z != self.header['shape'][0]:
+            self._fh.close()
+            self._fh = None
+            os.remove(self._tmp_path)
+            raise ValueError("volume incomplete: {} of {} slices written".format(self.z, self.header['shape'][0]))
+        header = json.dumps(self.header).encode('utf-8')
+        header_offset = self._fh.tell()
+        self._fh.write(header)
+        self._fh.seek(0)
+        self._fh.write(CTV_MAGIC + struct.pack('<QQ', header_offset, len(header)))
+        self._fh.close()
+        self._fh = None
+        os.replace(self._tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._fh is not None:
+            self._fh.close()
+            self._fh = None
+            os.remove(self._tmp_path)
+
+
+class CTVolume:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            preamble = fh.read(CTV_DATA_OFFSET)
+            if preamble[:len(CTV_MAGIC)] != CTV_MAGIC:
+                raise ValueError("not a .ctv volume: " + path)
+            header_offset, header_length = struct.unpack('<QQ', preamble[len(CTV_MAGIC):len(CTV_MAGIC) + 16])
+            fh.seek(header_offset)
+            self.header = json.loads(fh.read(header_length).decode('utf-8'))
+        self.shape = tuple(self.header['shape'])
+        self.dtype = np.dtype(self.header['dtype'])
+        self.spacing = np.array(self.header['spacing'], dtype=np.float32)
+        self.label = self.header['label']
+        self.attrs = self.header['attrs']
+        self.compression = self.header['compression']
+        self.chunk_depth = self.header['chunk_depth']
+        self._memmap = None
+        self._chunk_cache = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        volume = self.read()
+        return volume if dtype is None else volume.astype(dtype)
+
+    def memmap(self):
+        if self.compression is not None:
+            raise ValueError("compressed volumes cannot be memory-mapped: " + self.path)
+        if self._memmap is None:
+            self._memmap = np.memmap(self.path, dtype=self.dtype, mode='r', offset=CTV_DATA_OFFSET, shape=self.shape)
+        return self._memmap
+
+    def _chunk(self, index):
+        if index not in self._chunk_cache:
+            offset, length = self.header['chunks'][index]
+            with open(self.path, 'rb') as fh:
+                fh.seek(CTV_DATA_OFFSET + offset)
+                data = zlib.decompress(fh.read(length))
+            depth = min(self.chunk_depth, self.shape[0] - index * self.chunk_depth)
+            # Keep only the most recently used chunk: sequential slice access decompresses each chunk once
+            self._chunk_cache = {index: np.frombuffer(data, dtype=self.dtype).reshape((depth,) + self.shape[1:])}
+        return self._chunk_cache[index]
+
+    def read(self, z_start=0, z_stop=None):
+        z_start, z_stop, _ = slice(z_start, z_stop).indices(self.shape[0])
+        if self.compression is None:
+            return np.array(self.memmap()[z_start:z_stop])
+        out = np.empty((max(0, z_stop - z_start),) + self.shape[1:], dtype=self.dtype)
+        z = z_start
+        while z < z_stop:
+            index = z // self.chunk_depth
+            chunk_start = index * self.chunk_depth
+            chunk = self._chunk(index)
+            stop = min(z_stop, chunk_start + len(chunk))
+            out[z - z_start:stop - z_start] = chunk[z - chunk_start:stop - chunk_start]
+            z = stop
+        return out
+
+    def __getitem__(self, key):
+        if self.compression is None:
+            return self.memmap()[key]
+        key = key if isinstance(key, tuple) else (key,)
+        z_key, rest = key[0], key[1:]
+        if isinstance(z_key, (int, np.integer)):
+            z = int(z_key) + (self.shape[0] if z_key < 0 else 0)
+            return self.read(z, z + 1)[(0,) + rest]
+        if isinstance(z_key, slice):
+            z_start, z_stop, z_step = z_key.indices(self.shape[0])
+            if z_step < 0:
+                return self.read()[key]
+            return self.read(z_start, z_stop)[(slice(None, None, z_step),) + rest]
+        return self.read()[key]
+
+
+def open_volume(path):
+    return CTVolume(path)
+
+
+def write_volume(path, volume, spacing, label=None, chunk_depth=CTV_CHUNK_DEPTH, compression=None, level=1,
+                 attrs=None):
+    with VolumeWriter(path, volume.shape, volume.dtype, spacing, label=label, chunk_depth=chunk_depth,
+                      compression=compression, level=level, attrs=attrs) as writer:
+        for z_start in range(0, volume.shape[0], chunk_depth):
+            writer.write(volume[z_start:z_start + chunk_depth])
+    log("write_volume|Info ==> saved", str(tuple(volume.shape)), "to:", path)
+
+
+@instrumented()
+def save_ct_pixels(output_dir, name, ct_pixels, ct_spacing, label=None, store_format='npy', compression='zlib'):
+    # Step 1 outputs: the legacy _ct-pixels/_ct-orig-shape/_ct-spacing .npy triplet, or one .ctv file
+    if store_format == 'ctv':
+        out_file = output_dir + name + "_ct-pixels" + CTV_EXTENSION
+        write_volume(out_file, ct_pixels, ct_spacing, label=label, compression=compression,
+                     attrs={'orig_shape': list(ct_pixels.shape)})
+        return [out_file]
+    out_files = [output_dir + name + "_ct-pixels.npy",
+                 output_dir + name + "_ct-orig-shape.npy",
+                 output_dir + name + "_ct-spacing.npy"]
+    for out_file, data in zip(out_files, [ct_pixels, ct_pixels.shape, ct_spacing]):
+        np.save(out_file, data)
+        log("Saved file: ", out_file)
+    return out_files
+
+
+def ct_pixels_files(output_dir, name, store_format='npy'):
+    if store_format == 'ctv':
+        return [output_dir + name + "_ct-pixels" + CTV_EXTENSION]
+    return [output_dir + name + "_ct-pixels.npy",
+            output_dir + name + "_ct-orig-shape.npy",
+            output_dir + name + "_ct-spacing.npy"]
+
+
+@instrumented()
+def load_ct_pixels(input_dir, name):
+    # Returns (pixels, spacing, orig_shape) from a .ctv volume if present, else from the .npy triplet
+    ctv_file = input_dir + name + "_ct-pixels" + CTV_EXTENSION
+    if os.path.isfile(ctv_file):
+        volume = open_volume(ctv_file)
+        log("Successfully loaded:", ctv_file)
+        return volume.read(), volume.spacing, np.array(volume.attrs.get('orig_shape', volume.shape))
+    pixels_file, orig_shape_file, spacing_file = ct_pixels_files(input_dir, name)
+    ct_pixels = np.load(pixels_file)
+    log("Successfully loaded:", pixels_file)
+    ct_spacing = np.load(spacing_file)
+    log("Successfully loaded:", spacing_file)
+    ct_orig_shape = np.load(orig_shape_file)
+    log("Successfully loaded:", orig_shape_file)
+    return ct_pixels, ct_spacing, ct_orig_shape
+
+
+def load_slices(path, mmap=False, dtype=None, decode=True):
+    # Slice stacks written by export_normal_slices, as .npy or .ctv. Quantized stacks are decoded to [0, 1]
+    # (float32 unless dtype is given) with their stored scale; decode=False returns the stored values.
+    scale = None
+    if path.endswith(CTV_EXTENSION):
+        volume = open_volume(path)
+        scale = volume.attrs.get('scale')
+        if mmap and volume.compression is None:
+            slices = volume.memmap()
+        else:
+            slices = volume.read()
+    else:
+        slices = np.load(path, mmap_mode='r' if mmap else None)
+    if not decode:
+        return slices
+    return decode_normalized(slices, scale, dtype)
@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+from skimage.transform import resize
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from dcm_utilities import load_ct_volume
+from instrumentation import LOG_LEVELS, log, patient_context, set_log_level, stage
+from utilities import resample_to_model_grid
+from slice_batcher import SLICE_BATCH_SIZE, SLICE_MAX_WAIT, SliceBatcher
+
+REPO_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+DEFAULT_BCDUNET_WEIGHTS = os.path.join(REPO_DIR, 'Model_weight', 'weight_BCDUNET.hdf5')
+DEFAULT_CNN_WEIGHTS = os.path.join(REPO_DIR, 'Model_weight', 'weight_cnn_CovidCtNet.h5')
+# Same grid as preprocessing step 2 with its default config (no lung segmentation or cropping)
+INFERENCE_SPACING = [1, 1, 1]
+BCDU_SLICE_SIZE = 128
+CNN_VOLUME_SHAPE = (50, 128, 128)
+CLASS_LABELS = ['Control', 'COVID-19', 'CAP']
+
+
+def preprocess_study(dcm_dir, new_spacing=INFERENCE_SPACING, io_workers=4, size=BCDU_SLICE_SIZE, bbox=None):
+    # Preprocessing steps 1 and 2 and the BCDU-Net slice resize in memory: DICOM series -> HU volume ->
+    # (n, size, size) slices of new_spacing normalized to [0, 1], in a single resampling. The 1 mm volume
+    # is only needed for exporting training patches (pipeline.py).
+    ct_pixels_hu, ct_spacing = load_ct_volume(dcm_dir, workers=io_workers)
+    return resample_to_model_grid(ct_pixels_hu, ct_spacing, size, new_spacing, bbox)
+
+
+def bcdunet_input(ct_norm, size=BCDU_SLICE_SIZE):
+    # As Testing-CovidCTNet, for volumes exported by preprocessing step 2: every slice resized to size x size
+    return resize(ct_norm, (ct_norm.shape[0], size, size), anti_aliasing=True)
+
+
+def difference_volume(ct_resized, reconstruction):
+    # BCDU-Net reconstruction subtracted from its input, resized to the 3D CNN input shape
+    return resize(ct_resized - reconstruction, CNN_VOLUME_SHAPE)
+
+
+class CovidCtNetPredictor:
+    # Loads BCDU-Net and the 3D CNN once and classifies DICOM series without intermediate files.
+    # models: an already built (bcdunet, cnn) pair, otherwise both are built and loaded from the weight files.
+    # BCDU-Net slices of all queued studies are packed into shared batches of batch_size (see SliceBatcher),
+    # and run while the next study is being preprocessed.
+
+    def __init__(self, bcdunet_weights=DEFAULT_BCDUNET_WEIGHTS, cnn_weights=DEFAULT_CNN_WEIGHTS,
+                 batch_size=SLICE_BATCH_SIZE, io_workers=4, models=None, max_wait=SLICE_MAX_WAIT):
+        start = time.perf_counter()
+        if models is None:
+            from models import load_models
+            models = load_models(bcdunet_weights, cnn_weights)
+        self.bcdunet, self.cnn = models
+        self.batch_size = batch_size
+        self.io_workers = io_workers
+        # Keras models are not safe to call from several threads at once
+        self._lock = threading.Lock()
+        self.batcher = SliceBatcher(self.bcdunet, batch_size, max_wait, postprocess=difference_volume, lock=self._lock)
+        log("CovidCtNetPredictor|Info ==> models ready in {:.1f}s".format(time.perf_counter() - start))
+
+    def difference_volume(self, ct_norm):
+        return self.batcher.submit(bcdunet_input(ct_norm)).result()
+
+    def classify(self, difference_volumes):
+        # (n, 3) class probabilities for (n,) + CNN_VOLUME_SHAPE difference volumes
+        batch = np.asarray(difference_volumes, dtype=np.float32)[..., None]
+        with stage('cnn_3d', inputs=batch), self._lock:
+            return np.asarray(self.cnn.predict(batch, batch_size=self.batch_size))
+
+    def close(self):
+        self.batcher.close()
+
+    def predict_volume(self, ct_norm):
+        return dict(zip(CLASS_LABELS, self.classify([self.difference_volume(ct_norm)])[0].tolist()))
+
+    def predict_studies(self, dcm_dirs):
+        # One result per series folder: probabilities per label and the predicted label, or the error.
+        # Each study is queued for BCDU-Net as soon as it is preprocessed; the 3D CNN runs once over all
+        # studies that got that far.
+        results, futures = [], []
+        for dcm_dir in dcm_dirs:
+            start = time.perf_counter()
+            result = {'study': dcm_dir}
+            try:
+                with patient_context(dcm_dir):
+                    ct_resized = preprocess_study(dcm_dir, io_workers=self.io_workers)
+                futures.append((result, self.batcher.submit(ct_resized, dcm_dir), time.perf_counter()))
+                result['seconds'] = {'preprocess': futures[-1][2] - start}
+            except Exception as e:
+                result['error'] = '{}: {}'.format(type(e).__name__, e)
+            results.append(result)
+
+        volumes = []
+        for result, future, submitted in futures:
+            try:
+                volumes.append(future.result())
+                result['seconds']['bcdunet'] = time.perf_counter() - submitted
+            except Exception as e:
+                result['error'] = '{}: {}'.format(type(e).__name__, e)
+        done = [result for result in results if 'error' not in result]
+        if done:
+            start = time.perf_counter()
+            probabilities = self.classify(volumes)
+            cnn_seconds = (time.perf_counter() - start) / len(done)
+            for result, study_probabilities in zip(done, probabilities):
+                result['probabilities'] = dict(zip(CLASS_LABELS, study_probabilities.tolist()))
+                result['prediction'] = CLASS_LABELS[int(np.argmax(study_probabilities))]
+                result['seconds']['cnn_3d'] = cnn_seconds
+                result['seconds']['total'] = sum(result['seconds'].values())
+        return results
+
+
+def print_results(results):
+    print("{:<50} {:>9} {:>9} {:>9}  {:<10} {:>8}".format('study', *CLASS_LABELS, 'prediction', 'seconds'))
+    for result in results:
+        if 'error' in result:
+            print("{:<50} error: {}".format(result['study'][-50:], result['error']))
+            continue
+        print("{:<50} {:9.4f} {:9.4f} {:9.4f}  {:<10} {:8.2f}".format(
+            result['study'][-50:], *(result['probabilities'][label] for label in CLASS_LABELS),
+            result['prediction'], result['seconds']['total']))
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+def make_handler(predictor):
+
+    class PredictHandler(BaseHTTPRequestHandler):
+        # GET /health; POST /predict with {"dcm_dir": "..."} or {"dcm_dirs": [...]} (folders on this host)
+
+        def _reply(self, code, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self._reply(404, {'error': 'unknown path ' + self.path})
+            self._reply(200, {'status': 'ok', 'labels': CLASS_LABELS})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self._reply(404, {'error': 'unknown path ' + self.path})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                dcm_dirs = request['dcm_dirs'] if 'dcm_dirs' in request else [request['dcm_dir']]
+            except (ValueError, KeyError, TypeError) as e:
+                return self._reply(400, {'error': 'expected {"dcm_dir": ...} or {"dcm_dirs": [...]}: ' + str(e)})
+            self._reply(200, {'results': predictor.predict_studies(dcm_dirs)})
+
+        def log_message(self, format, *args):
+            log("serve|Info ==> " + format % args)
+
+    return PredictHandler
+
+
+def serve(predictor, host='127.0.0.1', port=8000, unix_socket=None):
+    # Requests are handled one at a time, so studies never compete for the models or memory
+    handler = make_handler(predictor)
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, handler)
+        log("serve|Info ==> listening on unix socket", unix_socket)
+    else:
+        server = HTTPServer((host, port), handler)
+        log("serve|Info ==> listening on http://{}:{}".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify CT series (DICOM folders) as Control, COVID-19 or CAP")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    predict = subparsers.add_parser('predict', help="classify DICOM folders and exit")
+    predict.add_argument('dcm_dirs', nargs='+', help="one folder of .dcm slices per study")
+    predict.add_argument('--json', help="write the results to this file")
+    service = subparsers.add_parser('serve', help="keep the models loaded and answer HTTP requests")
+    service.add_argument('--host', default='127.0.0.1')
+    service.add_argument('--port', type=int, default=8000)
+    service.add_argument('--unix-socket', help="listen on this unix socket instead of a TCP port")
+    for subparser in (predict, service):
+        subparser.add_argument('--bcdunet-weights', default=DEFAULT_BCDUNET_WEIGHTS)
+        subparser.add_argument('--cnn-weights', default=DEFAULT_CNN_WEIGHTS)
+        subparser.add_argument('--batch-size', type=int, default=SLICE_BATCH_SIZE, help="BCDU-Net slices per batch")
+        subparser.add_argument('--max-wait', type=float, default=SLICE_MAX_WAIT,
+                               help="seconds a partial BCDU-Net batch waits for slices of further studies")
+        subparser.add_argument('--io-workers', type=int, default=4, help="threads reading DICOM files")
+        subparser.add_argument('--log-level', choices=list(LOG_LEVELS), default='warn')
+    args = parser.parse_args(argv)
+
+    set_log_level(args.log_level)
+    predictor = CovidCtNetPredictor(args.bcdunet_weights, args.cnn_weights, args.batch_size, args.io_workers,
+                                    max_wait=args.max_wait)
+    if args.command == 'serve':
+        serve(predictor, args.host, args.port, args.unix_socket)
+        return 0
+    results = predictor.predict_studies(args.dcm_dirs)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+from __future__ import division
+
+import numpy as np
+from keras.models import Model, Sequential
+from keras.layers import Input, concatenate, Conv2D, MaxPooling2D, Reshape, Dropout, Conv2DTranspose
+from keras.layers import BatchNormalization, Activation, ConvLSTM2D
+from keras.layers import Dense, Flatten, Conv3D, MaxPooling3D
+
+# Input sizes the published weights were trained with
+BCDU_INPUT_SIZE = (128, 128, 1)
+CNN_INPUT_SHAPE = (50, 128, 128, 1)
+
+
+def BCDU_net_D3(input_size=BCDU_INPUT_SIZE):
+    N = input_size[0]
+    inputs = Input(input_size)
+    conv1 = Conv2D(32, 3, activation='relu', padding='same', kernel_initializer='he_normal')(inputs)
+    conv1 = Conv2D(32, 3, activation='relu', padding='same', kernel_initializer='he_normal')(conv1)
+
+    pool1 = MaxPooling2D(pool_size=(2, 2))(conv1)
+    conv2 = Conv2D(64, 3, activation='relu', padding='same', kernel_initializer='he_normal')(pool1)
+    conv2 = Conv2D(64, 3, activation='relu', padding='same', kernel_initializer='he_normal')(conv2)
+    pool2 = MaxPooling2D(pool_size=(2, 2))(conv2)
+    conv3 = Conv2D(128, 3, activation='relu', padding='same', kernel_initializer='he_normal')(pool2)
+    conv3 = Conv2D(128, 3, activation='relu', padding='same', kernel_initializer='he_normal')(conv3)
+    drop3 = Dropout(0.5)(conv3)
+    pool3 = MaxPooling2D(pool_size=(2, 2))(conv3)
+    # D1
+    conv4 = Conv2D(256, 3, activation='relu', padding='same', kernel_initializer='he_normal')(pool3)
+    conv4_1 = Conv2D(256, 3, activation='relu', padding='same', kernel_initializer='he_normal')(conv4)
+    drop4_1 = Dropout(0.5)(conv4_1)
+    # D2
+    conv4_2 = Conv2D(256, 3, activation='relu', padding='same', kernel_initializer='he_normal')(drop4_1)
+    conv4_2 = Conv2D(256, 3, activation='relu', padding='same', kernel_initializer='he_normal')(conv4_2)
+    conv4_2 = Dropout(0.5)(conv4_2)
+    # D3
+    merge_dense = concatenate([conv4_2, drop4_1], axis=3)
+    conv4_3 = Conv2D(256, 3, activation='relu', padding='same', kernel_initializer='he_normal')(merge_dense)
+    conv4_3 = Conv2D(256, 3, activation='relu', padding='same', kernel_initializer='he_normal')(conv4_3)
+    drop4_3 = Dropout(0.5)(conv4_3)
+
+    up6 = Conv2DTranspose(128, kernel_size=2, strides=2, padding='same', kernel_initializer='he_normal')(drop4_3)
+    up6 = BatchNormalization(axis=3)(up6)
+    up6 = Activation('relu')(up6)
+
+    x1 = Reshape(target_shape=(1, np.int32(N / 4), np.int32(N / 4), 128))(drop3)
+    x2 = Reshape(target_shape=(1, np.int32(N / 4), np.int32(N / 4), 128))(up6)
+    merge6 = concatenate([x1, x2], axis=1)
+    merge6 = ConvLSTM2D(filters=64, kernel_size=(3, 3), padding='same', return_sequences=False, go_backwards=True,
+                        kernel_initializer='he_normal')(merge6)
+
+    conv6 = Conv2D(128, 3, activation='relu', padding='same', kernel_initializer='he_normal')(merge6)
+    conv6 = Conv2D(128, 3, activation='relu', padding='same', kernel_initializer='he_normal')(conv6)
+
+    up7 = Conv2DTranspose(64, kernel_size=2, strides=2, padding='same', kernel_initializer='he_normal')(conv6)
+    up7 = BatchNormalization(axis=3)(up7)
+    up7 = Activation('relu')(up7)
+
+    x1 = Reshape(target_shape=(1, np.int32(N / 2), np.int32(N / 2), 64))(conv2)
+    x2 = Reshape(target_shape=(1, np.int32(N / 2), np.int32(N / 2), 64))(up7)
+    merge7 = concatenate([x1, x2], axis=1)
+    merge7 = ConvLSTM2D(filters=32, kernel_size=(3, 3), padding='same', return_sequences=False, go_backwards=True,
+                        kernel_initializer='he_normal')(merge7)
+
+    conv7 = Conv2D(64, 3, activation='relu', padding='same', kernel_initializer='he_normal')(merge7)
+    conv7 = Conv2D(64, 3, activation='relu', padding='same', kernel_initializer='he_normal')(conv7)
+
+    up8 = Conv2DTranspose(32, kernel_size=2, strides=2, padding='same', kernel_initializer='he_normal')(conv7)
+    up8 = BatchNormalization(axis=3)(up8)
+    up8 = Activation('relu')(up8)
+
+    x1 = Reshape(target_shape=(1, N, N, 32))(conv1)
+    x2 = Reshape(target_shape=(1, N, N, 32))(up8)
+    merge8 = concatenate([x1, x2], axis=1)
+    merge8 = ConvLSTM2D(filters=16, kernel_size=(3, 3), padding='same', return_sequences=False, go_backwards=True,
+                        kernel_initializer='he_normal')(merge8)
+
+    conv8 = Conv2D(32, 3, activation='relu', padding='same', kernel_initializer='he_normal')(merge8)
+    conv8 = Conv2D(32, 3, activation='relu', padding='same', kernel_initializer='he_normal')(conv8)
+    conv8 = Conv2D(2, 3, activation='relu', padding='same', kernel_initializer='he_normal')(conv8)
+    conv9 = Conv2D(1, 1, activation='sigmoid')(conv8)
+
+    model = Model(inputs, conv9)
+    return model
+
+
+def CovidCtNet_3D(input_shape=CNN_INPUT_SHAPE):
+    # 3D CNN classifying BCDU-Net difference volumes as Control, COVID-19 or CAP
+    model = Sequential()
+    model.add(Conv3D(8, kernel_size=(3, 3, 3), activation='relu', kernel_initializer='he_uniform',
+                     input_shape=input_shape))
+    model.add(Conv3D(8, kernel_size=(3, 3, 3), activation='relu', kernel_initializer='he_uniform', padding='same'))
+    model.add(MaxPooling3D(pool_size=(2, 2, 2)))
+
+    for filters in (16, 32, 64, 128):
+        model.add(Conv3D(filters, kernel_size=(3, 3, 3), activation='relu', kernel_initializer='he_uniform',
+                         padding='same'))
+        model.add(Conv3D(filters, kernel_size=(3, 3, 3), activation='relu', kernel_initializer='he_uniform',
+                         padding='same'))
+        model.add(MaxPooling3D(pool_size=(2, 2, 2)))
+
+    model.add(Flatten())
+    model.add(Dense(32, activation='relu', kernel_initializer='he_uniform'))
+    model.add(Dropout(0.3))
+    model.add(Dense(3, activation='softmax'))
+    return model
+
+
+def load_models(bcdunet_weights, cnn_weights):
+    # Both networks built in memory with their weights; no model.json round trip
+    bcdunet = BCDU_net_D3(BCDU_INPUT_SIZE)
+    bcdunet.load_weights(bcdunet_weights)
+    cnn = CovidCtNet_3D(CNN_INPUT_SHAPE)
+    cnn.load_weights(cnn_weights)
+    return bcdunet, cnn
@@ -0,0 +1,165 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+# add_noise in Training-CovidCTNet: scale randint(10, 30), persistence 0.01 * randint(-50, 50), 10 octaves,
+# lacunarity 2, lattice repeating every 140 units
+NOISE_SCALE_RANGE = (10, 30)
+NOISE_PERSISTENCE_RANGE = (-0.5, 0.5)
+NOISE_OCTAVES = 10
+NOISE_LACUNARITY = 2.0
+NOISE_REPEAT = 140
+NOISE_BANK_SIZE = 256
+# Bank fields are this many pixels larger than the slices, so that random crops shift the noise
+NOISE_BANK_MARGIN = 32
+
+
+# x, y components of the 12 gradients of the noise package (Perlin's 3D gradients, z dropped)
+GRADIENTS_2D = np.array([[1, 1], [-1, 1], [1, -1], [-1, -1], [1, 0], [-1, 0], [1, 0], [-1, 0],
+                         [0, 1], [0, -1], [0, 1], [0, -1]], dtype=np.float64)
+
+
+def _gradients(seed):
+    # Permutation table (doubled, as in Perlin's reference code) and the x, y gradient components per hash
+    rng = np.random.default_rng(seed)
+    perm = rng.permutation(256)
+    gradients = GRADIENTS_2D[np.arange(256) % len(GRADIENTS_2D)]
+    return np.concatenate([perm, perm]), gradients[:, 0], gradients[:, 1]
+
+
+def _fade(t):
+    return t * t * t * (t * (t * 6 - 15) + 10)
+
+
+def _lattice(coords, repeat=None):
+    # Lattice cell corners (wrapped every `repeat` cells) and offsets within the cell of 1D coordinates
+    cell = np.floor(coords)
+    offset = coords - cell
+    cell = cell.astype(np.int64)
+    next_cell = cell + 1
+    if repeat:
+        cell, next_cell = cell % repeat, next_cell % repeat
+    return cell & 255, next_cell & 255, offset
+
+
+def _gradient_noise(x, y, perm, grad_x, grad_y, repeat=None):
+    # One octave of 2D Perlin noise on the grid of x (rows) by y (columns). Cells, offsets and fades are
+    # computed per axis; only the corner hashes and dot products are evaluated for every point.
+    x0, x1, fx = _lattice(x, repeat)
+    y0, y1, fy = _lattice(y, repeat)
+    fx, fy = fx[:, None], fy[None, :]
+
+    def dot(hx, iy, dx, dy):
+        h = perm[perm[hx][:, None] + iy[None, :]]
+        return grad_x[h] * dx + grad_y[h] * dy
+
+    n00 = dot(x0, y0, fx, fy)
+    n10 = dot(x1, y0, fx - 1, fy)
+    n01 = dot(x0, y1, fx, fy - 1)
+    n11 = dot(x1, y1, fx - 1, fy - 1)
+    u, v = _fade(fx), _fade(fy)
+    bottom = n00 + u * (n10 - n00)
+    top = n01 + u * (n11 - n01)
+    return bottom + v * (top - bottom)
+
+
+def perlin_noise_2d(shape=(128, 128), scale=10., octaves=NOISE_OCTAVES, persistence=0.5, lacunarity=NOISE_LACUNARITY,
+                    repeat=NOISE_REPEAT, seed=0):
+    # world[i, j] = noise.pnoise2(i / scale, j / scale, ...) of add_noise, evaluated for the whole grid per
+    # octave: amplitudes persistence ** k at frequencies lacunarity ** k, divided by the sum of the amplitudes.
+    # The same kind of noise with the same parameters, not the same values as the noise package.
+    perm, grad_x, grad_y = _gradients(seed)
+    x, y = np.arange(shape[0]) / scale, np.arange(shape[1]) / scale
+    total = np.zeros(shape, dtype=np.float64)
+    amplitude, frequency, amplitude_sum = 1., 1., 0.
+    for _ in range(octaves):
+        # octaves below float32 resolution do not change the field
+        if abs(amplitude) < 1e-7:
+            break
+        total += amplitude * _gradient_noise(x * frequency, y * frequency, perm, grad_x, grad_y,
+                                             int(repeat * frequency) if repeat else None)
+        amplitude_sum += amplitude
+        amplitude *= persistence
+        frequency *= lacunarity
+    return total / amplitude_sum
+
+
+class PerlinNoiseBank:
+    # Seeded bank of pre-generated noise fields with add_noise's random parameters. sample() returns randomly
+    # cropped, rotated and flipped fields, so a small bank gives many different noise patterns.
+
+    def __init__(self, size=NOISE_BANK_SIZE, shape=(128, 128), scale_range=NOISE_SCALE_RANGE,
+                 persistence_range=NOISE_PERSISTENCE_RANGE, octaves=NOISE_OCTAVES, lacunarity=NOISE_LACUNARITY,
+                 margin=NOISE_BANK_MARGIN, seed=0):
+        self.shape = tuple(shape)
+        self.margin = margin
+        rng = np.random.default_rng(seed)
+        field_shape = (self.shape[0] + margin, self.shape[1] + margin)
+        self.fields = np.empty((size,) + field_shape, dtype=np.float32)
+        self.params = []
+        for i in range(size):
+            params = {'scale': int(rng.integers(*scale_range)),
+                      'persistence': 0.01 * int(rng.integers(round(100 * persistence_range[0]),
+                                                              round(100 * persistence_range[1]))),
+                      'octaves': octaves, 'lacunarity': lacunarity, 'seed': int(rng.integers(0, 1000))}
+            self.fields[i] = perlin_noise_2d(field_shape, **params)
+            self.params.append(params)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def sample(self, count, rng=None):
+        # (count,) + shape noise fields
+        rng = rng if rng is not None else np.random.default_rng()
+        out = np.empty((count,) + self.shape, dtype=np.float32)
+        for i, index in enumerate(rng.integers(0, len(self.fields), count)):
+            y, x = rng.integers(0, self.margin + 1, 2)
+            field = self.fields[index, y:y + self.shape[0], x:x + self.shape[1]]
+            field = np.rot90(field, rng.integers(0, 4)) if self.shape[0] == self.shape[1] else field
+            out[i] = field[:, ::-1] if rng.random() < 0.5 else field
+        return out
+
+    def add_noise(self, slices, rng=None, noisy_fraction=1.):
+        # slices + noise (as cv2.addWeighted(slice, 1, world, 1, 0)) for a random noisy_fraction of the slices
+        rng = rng if rng is not None else np.random.default_rng()
+        noisy = np.array(slices, dtype=np.float32)
+        selected = np.flatnonzero(rng.random(len(noisy)) < noisy_fraction)
+        noisy[selected] += self.sample(len(selected), rng)
+        return noisy
+
+
+def noisy_batches(slices, bank, batch_size=5, noisy_fraction=0.5, shuffle=True, seed=None):
+    # Endless (noisy input, clean target) batches of shape (batch_size, H, W, 1) for model.fit, with the noise
+    # drawn from the bank when the batch is built instead of a noisy copy of the whole training set
+    rng = np.random.default_rng(seed)
+    slices = np.asarray(slices)
+    while True:
+        order = rng.permutation(len(slices)) if shuffle else np.arange(len(slices))
+        for start in range(0, len(order), batch_size):
+            clean = slices[order[start:start + batch_size]].astype(np.float32)
+            yield bank.add_noise(clean, rng, noisy_fraction)[..., None], clean[..., None]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the noise bank and on-the-fly noisy batches")
+    parser.add_argument('--bank-size', type=int, default=NOISE_BANK_SIZE)
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    bank = PerlinNoiseBank(args.bank_size)
+    print("perlin_noise|Info ==> bank of {} fields in {:.2f}s".format(len(bank), time.perf_counter() - start))
+    batches = noisy_batches(np.zeros((64, 128, 128), dtype=np.float32), bank, args.batch_size)
+    start = time.perf_counter()
+    for _ in range(args.batches):
+        next(batches)
+    elapsed = time.perf_counter() - start
+    print("perlin_noise|Info ==> {:.1f} noisy slices/s".format(args.batches * args.batch_size / elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+import argparse
+import collections
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from instrumentation import log, stage
+
+SLICE_BATCH_SIZE = 32
+SLICE_MAX_WAIT = 0.05
+
+
+class _Volume:
+
+    def __init__(self, key, slices, future):
+        self.key = key
+        self.slices = slices
+        self.future = future
+        self.out = None
+        self.scheduled = 0
+        self.done = 0
+        self.queued = time.perf_counter()
+
+
+class SliceBatcher:
+    # Packs the slices of queued volumes (n, H, W) into batches of batch_size for a 2D model, across volumes.
+    # A partial batch waits at most max_wait seconds for more volumes, trading latency for throughput.
+    # Predictions are scattered back per volume; a volume's future resolves with
+    # postprocess(slices, predictions) (the predictions alone without postprocess) as soon as its
+    # last slice is done. pad=True always feeds the model exactly batch_size slices (zeros appended).
+    # All volumes must have the same H x W (slice_shape, else that of the first volume submitted).
+
+    def __init__(self, model, batch_size=SLICE_BATCH_SIZE, max_wait=SLICE_MAX_WAIT, postprocess=None, pad=False,
+                 lock=None, slice_shape=None):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.postprocess = postprocess
+        self.pad = pad
+        self.lock = lock or threading.Lock()
+        self.slice_shape = tuple(slice_shape) if slice_shape is not None else None
+        self.stats = {'batches': 0, 'slices': 0, 'padded': 0, 'volumes': 0, 'predict_seconds': 0.}
+        self._pending = collections.deque()
+        self._queued_slices = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='SliceBatcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, slices, key=None):
+        slices = np.asarray(slices, dtype=np.float32)
+        if slices.ndim != 3:
+            raise ValueError("expected slices of shape (n, H, W), got {}".format(slices.shape))
+        future = Future()
+        volume = _Volume(key, slices, future)
+        if len(slices) == 0:
+            self._finish(volume)
+            return future
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("SliceBatcher is closed")
+            # Slices of different sizes cannot share a batch
+            if self.slice_shape is None:
+                self.slice_shape = slices.shape[1:]
+            elif slices.shape[1:] != self.slice_shape:
+                raise ValueError("expected slices of shape (n, {}, {}), got {}".format(
+                    self.slice_shape[0], self.slice_shape[1], slices.shape))
+            self._pending.append(volume)
+            self._queued_slices += len(slices)
+            self._cond.notify()
+        return future
+
+    def map(self, volumes):
+        # Results for all volumes in order, with every volume queued before the first batch is formed
+        futures = [self.submit(slices, key) for key, slices in enumerate(volumes)]
+        return [future.result() for future in futures]
+
+    def close(self):
+        # Predicts what is still queued, then stops the worker thread
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _take(self):
+        # (volume, start, stop) slice ranges filling one batch, oldest volumes first
+        ranges, space = [], self.batch_size
+        while self._pending and space:
+            volume = self._pending[0]
+            count = min(space, len(volume.slices) - volume.scheduled)
+            ranges.append((volume, volume.scheduled, volume.scheduled + count))
+            volume.scheduled += count
+            space -= count
+            if volume.scheduled == len(volume.slices):
+                self._pending.popleft()
+        self._queued_slices -= self.batch_size - space
+        return ranges
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                deadline = self._pending[0].queued + self.max_wait
+                while self._queued_slices < self.batch_size and not self._closed:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                ranges = self._take()
+            # A failing batch fails its volumes, not the thread the other volumes wait on
+            try:
+                self._predict(ranges)
+            except Exception as e:
+                log("SliceBatcher|Error:", str(e))
+                self._fail(ranges, e)
+
+    def _predict(self, ranges):
+        count = sum(stop - start for _, start, stop in ranges)
+        shape = ranges[0][0].slices.shape[1:]
+        try:
+            batch = np.zeros((self.batch_size if self.pad else count,) + shape + (1,), dtype=np.float32)
+            position = 0
+            for volume, start, stop in ranges:
+                batch[position:position + stop - start, ..., 0] = volume.slices[start:stop]
+                position += stop - start
+            start_time = time.perf_counter()
+            with stage('slice_batch', inputs=batch), self.lock:
+                predictions = np.asarray(self.model.predict(batch, batch_size=len(batch)))
+            self.stats['predict_seconds'] += time.perf_counter() - start_time
+        except Exception as e:
+            self._fail(ranges, e)
+            return
+        self.stats['batches'] += 1
+        self.stats['slices'] += count
+        self.stats['padded'] += len(batch) - count
+        position = 0
+        for volume, start, stop in ranges:
+            if volume.out is None:
+                volume.out = np.empty(volume.slices.shape, dtype=predictions.dtype)
+            volume.out[start:stop] = predictions[position:position + stop - start].reshape((stop - start,) + shape)
+            position += stop - start
+            volume.done += stop - start
+            if volume.done == len(volume.slices) and not volume.future.done():
+                self._finish(volume)
+
+    def _fail(self, ranges, e):
+        for volume, _, _ in ranges:
+            if not volume.future.done():
+                volume.future.set_exception(e)
+
+    def _finish(self, volume):
+        self.stats['volumes'] += 1
+        try:
+            out = volume.out if volume.out is not None else np.empty(volume.slices.shape, dtype=np.float32)
+            volume.future.set_result(self.postprocess(volume.slices, out) if self.postprocess else out)
+        except Exception as e:
+            volume.future.set_exception(e)
+
+
+def predict_per_patient(model, volumes, batch_size=SLICE_BATCH_SIZE):
+    # The notebooks' loop: one model.predict call per patient
+    return [np.asarray(model.predict(volume[..., None], batch_size=batch_size))[..., 0] for volume in volumes]
+
+
+def benchmark_slice_batching(model, volumes, batch_sizes=(16, 32, 64), max_wait=SLICE_MAX_WAIT, arrival=0.):
+    # Slices per second of the per-patient loop and of SliceBatcher; volumes are submitted `arrival`
+    # seconds apart to mimic studies coming in one by one. Returns {name: result}.
+    total = sum(len(volume) for volume in volumes)
+    results = {}
+    start = time.perf_counter()
+    reference = predict_per_patient(model, volumes)
+    elapsed = time.perf_counter() - start
+    results['per_patient'] = {'seconds': elapsed, 'slices_per_second': total / elapsed, 'calls': len(volumes)}
+    for batch_size in batch_sizes:
+        with SliceBatcher(model, batch_size=batch_size, max_wait=max_wait) as batcher:
+            start = time.perf_counter()
+            futures = []
+            for volume in volumes:
+                futures.append(batcher.submit(volume))
+                if arrival:
+                    time.sleep(arrival)
+            outputs = [future.result() for future in futures]
+            elapsed = time.perf_counter() - start
+        error = max(float(np.max(np.abs(out - ref), initial=0.)) for out, ref in zip(outputs, reference))
+        results['batched[{}]'.format(batch_size)] = {'seconds': elapsed, 'slices_per_second': total / elapsed,
+                                                     'calls': batcher.stats['batches'], 'max_abs_diff': error}
+
+    log("benchmark_slice_batching|Info ==> {} volumes, {} slices".format(len(volumes), total))
+    baseline = results['per_patient']['seconds']
+    for name, result in results.items():
+        log("{:<16} {:8.3f}s  {:8.1f} slices/s  speedup x{:.2f}  predict calls {:4d}".format(
+            name, result['seconds'], result['slices_per_second'], baseline / result['seconds'], result['calls']))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark cross-patient slice batching on BCDU_net_D3")
+    parser.add_argument('--patients', type=int, default=12)
+    parser.add_argument('--min-slices', type=int, default=8)
+    parser.add_argument('--max-slices', type=int, default=60)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 32, 64])
+    parser.add_argument('--max-wait', type=float, default=SLICE_MAX_WAIT)
+    parser.add_argument('--arrival', type=float, default=0., help="seconds between submitted patients")
+    parser.add_argument('--weights', help="BCDU-Net weights; random initialization gives the same timings")
+    args = parser.parse_args(argv)
+
+    from models import BCDU_net_D3
+    model = BCDU_net_D3()
+    if args.weights:
+        model.load_weights(args.weights)
+    rng = np.random.default_rng(0)
+    volumes = [rng.random((n, 128, 128), dtype=np.float32)
+               for n in rng.integers(args.min_slices, args.max_slices + 1, args.patients)]
+    benchmark_slice_batching(model, volumes, args.batch_sizes, args.max_wait, args.arrival)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
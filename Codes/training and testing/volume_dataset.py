@@ -0,0 +1,147 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from skimage.transform import resize
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+from patch_index import PATCH_LABELS, PatchSourceCache, volume_shape
+from volume_store import decode_normalized
+
+try:
+    from keras.utils import Sequence
+except ImportError:  # keras is only needed to pass the datasets to model.fit
+    Sequence = object
+
+DATASET_WORKERS = 4
+DATASET_PREFETCH = 4
+
+
+class _PrefetchSequence(Sequence):
+    # Batches are built on a thread pool, at most `prefetch` batches ahead of the one requested.
+    # The order is shuffled per epoch with a generator seeded by (seed, epoch), and every batch gets its own
+    # (seed, epoch, index) generator for augment(batch, rng), so the batches do not depend on thread timing.
+    # Pass shuffle=False to model.fit: the sequence shuffles itself.
+
+    def __init__(self, count, batch_size, augment, shuffle, seed, workers, prefetch):
+        super().__init__()
+        self.count = count
+        self.batch_size = batch_size
+        self.augment = augment
+        self.shuffle = shuffle
+        self.seed = seed
+        self.prefetch = prefetch
+        self.epoch = 0
+        self._order = self._epoch_order()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return (self.count + self.batch_size - 1) // self.batch_size
+
+    def _epoch_order(self):
+        if not self.shuffle:
+            return np.arange(self.count)
+        return np.random.default_rng([self.seed, self.epoch]).permutation(self.count)
+
+    def _source(self, path):
+        # Memory-mapped files are kept open per thread, the least recently used closed beyond PATCH_SOURCE_CACHE
+        return self._local.__dict__.setdefault('sources', PatchSourceCache()).get(path)
+
+    def _batch(self, order, epoch, index):
+        items = order[index * self.batch_size:(index + 1) * self.batch_size]
+        batch = self._load(items)
+        if self.augment is None:
+            return self._pair(batch, batch, items)
+        rng = np.random.default_rng([self.seed, epoch, index])
+        return self._pair(self.augment(batch, rng), batch, items)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if self._executor is None:
+            return self._batch(self._order, self.epoch, index)
+        with self._lock:
+            # Drop batches outside the prefetch window, e.g. after a jump
+            window = range(index, min(index + self.prefetch, len(self)))
+            for key in [key for key in self._pending if key not in window]:
+                self._pending.pop(key).cancel()
+            for key in window:
+                if key not in self._pending:
+                    self._pending[key] = self._executor.submit(self._batch, self._order, self.epoch, key)
+            future = self._pending.pop(index)
+        return future.result()
+
+    def on_epoch_end(self):
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending = {}
+            self.epoch += 1
+            self._order = self._epoch_order()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+class SliceSequence(_PrefetchSequence):
+    # Per-slice mode, for BCDU-Net: batches of single slices from all files, resized to size x size.
+    # Yields (augment(slices, rng), slices) with shape (batch_size, size, size, 1); without augment the
+    # input is the target. Only the header of each file is read up front.
+
+    def __init__(self, files, batch_size=5, size=128, augment=None, shuffle=True, seed=0, workers=DATASET_WORKERS,
+                 prefetch=DATASET_PREFETCH):
+        self.files = list(files)
+        self.size = size
+        counts = [volume_shape(path)[0] for path in self.files]
+        self.file_index = np.repeat(np.arange(len(self.files)), counts)
+        self.slice_index = np.concatenate([np.arange(n) for n in counts]) if counts else np.empty(0, dtype=np.int64)
+        super().__init__(len(self.file_index), batch_size, augment, shuffle, seed, workers, prefetch)
+
+    def _load(self, items):
+        slices = np.empty((len(items), self.size, self.size), dtype=np.float32)
+        # Read in file and slice order, each file visited once; the batch keeps the shuffled order
+        for i in np.lexsort((self.slice_index[items], self.file_index[items])):
+            source, scale = self._source(self.files[self.file_index[items[i]]])
+            ct_slice = decode_normalized(source[int(self.slice_index[items[i]])], scale)
+            if ct_slice.shape != slices.shape[1:]:
+                ct_slice = resize(ct_slice, slices.shape[1:], anti_aliasing=True)
+            slices[i] = ct_slice
+        return slices
+
+    def _pair(self, inputs, targets, items):
+        return inputs[..., None], targets[..., None]
+
+
+class VolumeSequence(_PrefetchSequence):
+    # Per-volume mode, for the 3D CNN: one volume per file (e.g. BCDU-Net difference volumes) resized to
+    # shape, with one-hot labels. labels default to the class of the file name prefix (PATCH_LABELS).
+    # Yields (volumes, labels) with shapes (batch_size,) + shape + (1,) and (batch_size, num_classes).
+
+    def __init__(self, files, labels=None, batch_size=16, shape=(50, 128, 128), num_classes=3, augment=None,
+                 shuffle=True, seed=0, workers=DATASET_WORKERS, prefetch=DATASET_PREFETCH):
+        self.files = list(files)
+        self.shape = tuple(shape)
+        if labels is None:
+            labels = [PATCH_LABELS.get(os.path.basename(path)[:1], -1) for path in self.files]
+            if -1 in labels:
+                raise ValueError("VolumeSequence needs labels for files not named H_/C_/P_...")
+        self.labels = np.eye(num_classes, dtype=np.float32)[np.asarray(labels, dtype=np.int64)]
+        super().__init__(len(self.files), batch_size, augment, shuffle, seed, workers, prefetch)
+
+    def _load(self, items):
+        volumes = np.empty((len(items),) + self.shape, dtype=np.float32)
+        for i, item in enumerate(items):
+            source, scale = self._source(self.files[item])
+            volume = decode_normalized(source[:], scale)
+            volumes[i] = volume if volume.shape == self.shape else resize(volume, self.shape, anti_aliasing=True)
+        return volumes
+
+    def _pair(self, inputs, targets, items):
+        return inputs[..., None], self.labels[items]